@@ -0,0 +1,81 @@
+"""
+Startup time benchmark.
+
+Measures, in fresh interpreters, how long importing `src.main` takes and how long `python -m src.server` takes until
+it answers its first request, against an SQLite database in a temporary directory. Exits with a non-zero status when
+the median of either exceeds its budget, so it can gate CI.
+
+Run with:
+```
+python -m benchmarks.bench_startup
+```
+"""
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+RUNS = 5
+IMPORT_BUDGET_SECONDS = float(os.getenv("STARTUP_IMPORT_BUDGET_SECONDS", "2"))
+BOOT_BUDGET_SECONDS = float(os.getenv("STARTUP_BOOT_BUDGET_SECONDS", "5"))
+BOOT_TIMEOUT_SECONDS = 30
+
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import src.main; print(time.perf_counter() - start)"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_import(env: dict) -> float:
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], env=env, check=True, capture_output=True,
+                            text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def measure_boot(env: dict) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "src.server"], env={**env, "PORT": str(port)},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < BOOT_TIMEOUT_SECONDS:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1)
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError(f"Server didn't answer within {BOOT_TIMEOUT_SECONDS}s")
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(BOOT_TIMEOUT_SECONDS)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, "DATABASE_URL": f"sqlite+aiosqlite:///{directory}/startup.db", "WEB_CONCURRENCY": "1",
+               "PYTHONPATH": os.getcwd()}
+        import_times = [measure_import(env) for _ in range(RUNS)]
+        boot_times = [measure_boot(env) for _ in range(RUNS)]
+
+    failed = False
+    for name, times, budget in (("import src.main", import_times, IMPORT_BUDGET_SECONDS),
+                                ("boot to first response", boot_times, BOOT_BUDGET_SECONDS)):
+        median = statistics.median(times)
+        print(f"{name:<24} median {median * 1000:8.1f} ms  max {max(times) * 1000:8.1f} ms  "
+              f"budget {budget * 1000:8.1f} ms")
+        failed = failed or median > budget
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
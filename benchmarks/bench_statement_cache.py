@@ -0,0 +1,74 @@
+"""
+Microbenchmark for the prebuilt hot-path statements.
+
+Compares building `select(...)` on every call (the old behaviour) with executing the
+prebuilt statements from `src.messages.service` against an in-memory SQLite database,
+and prints the compiled cache hit rate observed by `src.database`.
+
+Run with:
+```
+python -m benchmarks.bench_statement_cache
+```
+"""
+import asyncio
+import logging
+import time
+
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import sessionmaker
+
+from src.database import Base, DB_COMPILED_CACHE_COUNT, instrument_engine
+from src.messages.models import Message
+from src.messages.service import GET_MESSAGE_STMT
+
+ITERATIONS = 5000
+
+
+async def bench(db: AsyncSession, build_stmt) -> float:
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        stmt, params = build_stmt(i % 100 + 1)
+        result = await db.execute(stmt, params)
+        result.scalars().first()
+    return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+
+def inline_stmt(message_id):
+    return select(Message).filter(Message.id == message_id).limit(1), None
+
+
+def prebuilt_stmt(message_id):
+    return GET_MESSAGE_STMT, {"message_id": message_id}
+
+
+def cache_count(result: str) -> float:
+    return DB_COMPILED_CACHE_COUNT.labels(result=result)._value.get()
+
+
+async def main():
+    # Debug logging from `src.config` would dominate the timings.
+    logging.disable(logging.INFO)
+    engine = instrument_engine(create_async_engine("sqlite+aiosqlite://"))
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with session_factory() as db:
+        db.add_all([Message(text=f"message {i}") for i in range(100)])
+        await db.commit()
+
+        inline_us = await bench(db, inline_stmt)
+        hits, misses = cache_count("hit"), cache_count("miss")
+        prebuilt_us = await bench(db, prebuilt_stmt)
+        hits, misses = cache_count("hit") - hits, cache_count("miss") - misses
+
+    await engine.dispose()
+    print(f"inline select:   {inline_us:8.1f} us/query")
+    print(f"prebuilt select: {prebuilt_us:8.1f} us/query")
+    print(f"saved per query: {inline_us - prebuilt_us:8.1f} us")
+    print(f"compiled cache hit rate: {hits / max(hits + misses, 1):.2%}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,15 @@
+import json
+
+from fastapi import HTTPException, status
+
+profiler_busy_exception = HTTPException(
+    status_code=status.HTTP_409_CONFLICT,
+    detail=json.dumps("Profiler is already running"),
+    headers={"Content-Type": "application/json"},
+)
+
+profile_not_found_exception = HTTPException(
+    status_code=status.HTTP_404_NOT_FOUND,
+    detail=json.dumps("Profile not found"),
+    headers={"Content-Type": "application/json"},
+)
@@ -0,0 +1,221 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from src.auth.service import is_admin_token
+
+# Seconds between two samples, never below 1ms.
+PROFILER_INTERVAL_SECONDS = max(float(os.getenv("PROFILER_INTERVAL_SECONDS", "0.005")), 0.001)
+# Requests usually take a few milliseconds, so a single request is sampled more often.
+PROFILER_REQUEST_INTERVAL_SECONDS = max(float(os.getenv("PROFILER_REQUEST_INTERVAL_SECONDS", "0.001")), 0.001)
+PROFILER_MAX_DURATION_SECONDS = float(os.getenv("PROFILER_MAX_DURATION_SECONDS", "30"))
+# Minimum time between two header-triggered request profiles in one worker.
+PROFILER_REQUEST_MIN_INTERVAL_SECONDS = float(os.getenv("PROFILER_REQUEST_MIN_INTERVAL_SECONDS", "10"))
+PROFILER_KEEP_PROFILES = int(os.getenv("PROFILER_KEEP_PROFILES", "20"))
+
+Frame = Tuple[str, str, int]
+
+
+def frame_key(frame) -> Frame:
+    code = frame.f_code
+    return code.co_name, code.co_filename, code.co_firstlineno
+
+
+def thread_stack(frame, stop_frame=None) -> List[Frame]:
+    """Stack of `frame` from the outermost frame down, cut above `stop_frame` when it is on the stack."""
+    stack = []
+    while frame is not None:
+        stack.append(frame_key(frame))
+        if frame is stop_frame:
+            break
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def await_stack(coro) -> List[Frame]:
+    """Stack of a suspended coroutine, following the chain of awaited coroutines."""
+    stack = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            stack.append((f"<await {type(coro).__name__}>", "", 0))
+            break
+        stack.append(frame_key(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return stack
+
+
+class Profile:
+    def __init__(self, name: str, interval: float):
+        self.id = uuid4().hex
+        self.name = name
+        self.interval = interval
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.samples: Counter = Counter()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "samples": sum(self.samples.values()),
+        }
+
+    def to_collapsed(self) -> str:
+        lines = []
+        for stack, count in self.samples.most_common():
+            labels = [f"{name} ({os.path.basename(filename)}:{line})" if filename else name
+                      for name, filename, line in stack]
+            lines.append(f"{';'.join(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def to_speedscope(self) -> dict:
+        frames: Dict[Frame, int] = {}
+        samples, weights = [], []
+        for stack, count in self.samples.items():
+            samples.append([frames.setdefault(frame, len(frames)) for frame in stack])
+            weights.append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "src.admin.profiler",
+            "shared": {"frames": [{"name": name, "file": filename, "line": line}
+                                  for name, filename, line in frames]},
+            "profiles": [{
+                "type": "sampled",
+                "name": self.name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread from a background thread.
+
+    Without `task` every sample is the current stack of the loop thread. With `task` only that task is sampled:
+    its frames on the loop thread while it runs, or the chain of coroutines it is suspended in while it awaits.
+    """
+
+    def __init__(self, name: str, task: Optional[asyncio.Task] = None, interval: float = PROFILER_INTERVAL_SECONDS):
+        self.profile = Profile(name, interval)
+        self.task = task
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> Profile:
+        self._stopped.set()
+        self._thread.join()
+        self.profile.duration = time.time() - self.profile.started_at
+        return self.profile
+
+    def _run(self):
+        deadline = time.monotonic() + PROFILER_MAX_DURATION_SECONDS
+        while not self._stopped.wait(self.profile.interval) and time.monotonic() < deadline:
+            stack = self.sample()
+            if stack:
+                self.profile.samples[tuple(stack)] += 1
+
+    def sample(self) -> List[Frame]:
+        if self.task is None:
+            return thread_stack(sys._current_frames().get(self.thread_id))
+        if self.task.done():
+            return []
+        coro = self.task.get_coro()
+        if asyncio.current_task(self.loop) is self.task:
+            return thread_stack(sys._current_frames().get(self.thread_id), stop_frame=coro.cr_frame)
+        return await_stack(coro)
+
+
+class ProfilerState:
+    """Allows one profile at a time per worker and keeps the latest finished profiles."""
+
+    def __init__(self):
+        self.active: Optional[SamplingProfiler] = None
+        self.last_request_profile = 0.0
+        self.profiles: "OrderedDict[str, Profile]" = OrderedDict()
+
+    def can_profile_request(self) -> bool:
+        return self.active is None and \
+            time.monotonic() - self.last_request_profile >= PROFILER_REQUEST_MIN_INTERVAL_SECONDS
+
+    def start(self, name: str, task: Optional[asyncio.Task] = None) -> Optional[SamplingProfiler]:
+        if self.active is not None:
+            return None
+        if task is None:
+            self.active = SamplingProfiler(name).start()
+        else:
+            self.last_request_profile = time.monotonic()
+            self.active = SamplingProfiler(name, task=task, interval=PROFILER_REQUEST_INTERVAL_SECONDS).start()
+        return self.active
+
+    def stop(self) -> Profile:
+        profile = self.active.stop()
+        self.active = None
+        self.profiles[profile.id] = profile
+        while len(self.profiles) > PROFILER_KEEP_PROFILES:
+            self.profiles.popitem(last=False)
+        return profile
+
+
+profiler_state = ProfilerState()
+
+
+class ProfilerMiddleware:
+    """
+    Profiles a single request when it carries the `X-Profile` header and an admin bearer token.
+
+    The profile id is returned in the `X-Profile-Id` response header and the profile can be fetched from
+    `/admin/profiles/{profile_id}`. This is a plain ASGI middleware so the request runs in the task it samples.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profiler = profiler_state.start(f"{scope['method']} {scope['path']}", task=asyncio.current_task())
+        if profiler is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profiler.profile.id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profiler_state.stop()
+
+    @staticmethod
+    def _wants_profile(scope) -> bool:
+        headers = dict(scope.get("headers", []))
+        if b"x-profile" not in headers or not profiler_state.can_profile_request():
+            return False
+        scheme, _, token = headers.get(b"authorization", b"").decode().partition(" ")
+        return scheme == "Bearer" and is_admin_token(token)
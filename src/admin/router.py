@@ -0,0 +1,101 @@
+import asyncio
+
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from slowapi import Limiter
+from slowapi.util import get_remote_address
+
+from src.admin.exceptions import profiler_busy_exception, profile_not_found_exception
+from src.admin.profiler import profiler_state, Profile, PROFILER_MAX_DURATION_SECONDS
+from src.auth.service import AdminBearer
+from src.loop_monitor import loop_monitor
+
+router = APIRouter()
+limiter = Limiter(key_func=get_remote_address)
+
+prefix = "admin"
+
+PROFILE_FORMATS = "^(collapsed|speedscope)$"
+
+
+def render_profile(profile: Profile, format: str):
+    if format == "speedscope":
+        return JSONResponse(profile.to_speedscope())
+    return PlainTextResponse(profile.to_collapsed())
+
+
+@router.post(f"/{prefix}/profile",
+             dependencies=[Depends(AdminBearer())],
+             summary="Profile the worker",
+             tags=["Admin"])
+@limiter.limit("6/minute")
+async def profile_worker(request: Request,
+                         seconds: float = Query(5, gt=0, le=PROFILER_MAX_DURATION_SECONDS),
+                         format: str = Query("collapsed", pattern=PROFILE_FORMATS)):
+    """
+    Sample the event loop of the worker serving this request for `seconds` and return the profile.
+
+    - **seconds**: Profiling duration.
+    - **format**: `collapsed` (flamegraph.pl / speedscope text) or `speedscope` (speedscope JSON).
+
+    Example request:
+    ```
+    POST /admin/profile?seconds=10&format=speedscope
+    Authorization: Bearer <admin token>
+    ```
+
+    Only one profile can run per worker at a time, otherwise a `409 Conflict` error is returned.
+    """
+    if profiler_state.start("worker") is None:
+        raise profiler_busy_exception
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile = profiler_state.stop()
+    return render_profile(profile, format)
+
+
+@router.get(f"/{prefix}/profiles",
+            dependencies=[Depends(AdminBearer())],
+            summary="List stored profiles",
+            tags=["Admin"])
+@limiter.limit("60/minute")
+async def list_profiles(request: Request):
+    """
+    List the latest worker and request profiles kept by this worker.
+
+    Requests sent with an `X-Profile` header and an admin bearer token are profiled, their profile id is returned
+    in the `X-Profile-Id` response header.
+    """
+    return [profile.to_dict() for profile in reversed(profiler_state.profiles.values())]
+
+
+@router.get(f"/{prefix}/profiles/{{profile_id}}",
+            dependencies=[Depends(AdminBearer())],
+            summary="Get a stored profile",
+            tags=["Admin"])
+@limiter.limit("60/minute")
+async def get_profile(request: Request, profile_id: str,
+                      format: str = Query("collapsed", pattern=PROFILE_FORMATS)):
+    """
+    Return a stored profile as collapsed stacks or speedscope JSON.
+
+    If the profile does not exist on this worker, a `404 Not Found` error is returned.
+    """
+    profile = profiler_state.profiles.get(profile_id)
+    if profile is None:
+        raise profile_not_found_exception
+    return render_profile(profile, format)
+
+
+@router.get(f"/{prefix}/loop/blocks",
+            dependencies=[Depends(AdminBearer())],
+            summary="List event loop blocks",
+            tags=["Admin"])
+@limiter.limit("60/minute")
+async def list_loop_blocks(request: Request):
+    """
+    List the latest callbacks that held the event loop of this worker longer than `LOOP_BLOCK_THRESHOLD_SECONDS`,
+    newest first, with the route being served and the stack captured while the loop was blocked.
+    """
+    return list(reversed(loop_monitor.blocks))
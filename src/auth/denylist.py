@@ -0,0 +1,45 @@
+import heapq
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class TokenDenylist:
+    """
+    In-process set of revoked token ids.
+
+    Every entry is kept only until the token it refers to expires, after that the token is rejected by its
+    expiry check anyway. Lookups are a single dict access, so it is safe to check on every request.
+    """
+
+    def __init__(self):
+        self._expires: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+
+    def add(self, jti: str, expires_at: float):
+        now = time.time()
+        if expires_at <= now:
+            return
+        if self._expires.get(jti, 0) < expires_at:
+            self._expires[jti] = expires_at
+            heapq.heappush(self._heap, (expires_at, jti))
+        self.purge_expired(now)
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        purged = 0
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, jti = heapq.heappop(self._heap)
+            if self._expires.get(jti) == expires_at:
+                del self._expires[jti]
+                purged += 1
+        return purged
+
+    def __contains__(self, jti: str) -> bool:
+        expires_at = self._expires.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+
+denylist = TokenDenylist()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Boolean, Column, Integer, String
 from src.database import Base
 
 
@@ -10,3 +10,20 @@ class User(Base):
     name = Column(String, nullable=False)
     hashed_password = Column(String, nullable=False)
     last_login = Column(Integer, nullable=True)
+
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    jti = Column(String, primary_key=True)
+    email = Column(String, index=True, nullable=False)
+    expires_at = Column(Integer, index=True, nullable=False)
+    revoked = Column(Boolean, nullable=False, default=False)
+
+
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String, primary_key=True)
+    expires_at = Column(Integer, index=True, nullable=False)
+    revoked_at = Column(Integer, index=True, nullable=False)
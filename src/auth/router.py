@@ -3,7 +3,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from src.auth.schemas import CreateUserReq, Token, LoginUserReq
-from src.auth.service import create_user, authenticate_user, refresh_user_token, sign_jwt, JWTBearer
+from src.auth.service import create_user, authenticate_user, refresh_user_token, issue_tokens, revoke_user_tokens, \
+    JWTBearer
 from src.database import get_db
 
 router = APIRouter()
@@ -38,14 +39,15 @@ async def create_user_route(request: Request, user: CreateUserReq, db: AsyncSess
     ```
     {
         "access_token": "string",
-        "token_type": "bearer"
+        "token_type": "bearer",
+        "refresh_token": "string"
     }
     ```
 
-    Returns a bearer token upon successful user creation.
+    Returns a short-lived bearer token and a refresh token upon successful user creation.
     """
     user = await create_user(user, db)
-    return sign_jwt(user.email)
+    return await issue_tokens(user.email, db)
 
 
 @router.post(f"/{prefix}/login",
@@ -72,45 +74,67 @@ async def login_user(request: Request, login_user: LoginUserReq, db: AsyncSessio
     ```
     {
         "access_token": "string",
-        "token_type": "bearer"
+        "token_type": "bearer",
+        "refresh_token": "string"
     }
     ```
 
-    Returns a bearer token upon successful authentication. If the credentials are invalid, a `400 Bad Request` error is returned.
+    Returns a short-lived bearer token and a refresh token upon successful authentication. If the credentials are invalid, a `400 Bad Request` error is returned.
     """
     user = await authenticate_user(login_user.email, login_user.password, db)
     if not user:
         raise HTTPException(status_code=400, detail="Invalid credentials")
-    access_token = sign_jwt(user.email)
-    return access_token
+    return await issue_tokens(user.email, db)
 
 
 @router.get(f"/{prefix}/refresh",
             response_model=Token,
-            dependencies=[Depends(JWTBearer())],
             summary="Refresh user token",
             tags=["Auth"])
 @limiter.limit("10/minute")
-async def refresh_token(request: Request, token: str = Depends(JWTBearer())):
+async def refresh_token(request: Request, token: str = Depends(JWTBearer(token_type="refresh")),
+                        db: AsyncSession = Depends(get_db)):
     """
-    Refresh the user's authentication token using the existing one.
+    Exchange a refresh token for a new access token and a new refresh token.
 
-    - **token**: The existing JWT token.
+    - **token**: The refresh token returned by login, user creation or a previous refresh.
 
     Example request:
     ```
     GET /auth/refresh
-    Authorization: Bearer <token>
+    Authorization: Bearer <refresh_token>
     ```
 
     Example response:
     ```
     {
         "access_token": "string",
-        "token_type": "bearer"
+        "token_type": "bearer",
+        "refresh_token": "string"
     }
     ```
 
-    Returns a new token if the existing token is valid. If the token is invalid or expired, a `401 Unauthorized` error is returned.
+    Every refresh token can be used only once. Reusing a refresh token revokes all refresh tokens of the user.
+    If the token is invalid, expired or already used, a `401 Unauthorized` error is returned.
+    """
+    return await refresh_user_token(token, db)
+
+
+@router.post(f"/{prefix}/logout",
+             status_code=204,
+             summary="Revoke user tokens",
+             tags=["Auth"])
+@limiter.limit("10/minute")
+async def logout(request: Request, token: str = Depends(JWTBearer()), db: AsyncSession = Depends(get_db)):
+    """
+    Revoke the access token used for this request and all refresh tokens of the user.
+
+    Example request:
+    ```
+    POST /auth/logout
+    Authorization: Bearer <token>
+    ```
+
+    The revoked access token is rejected by every worker from the next denylist sync on.
     """
-    return await refresh_user_token(token)
+    await revoke_user_tokens(token, db)
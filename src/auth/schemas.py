@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import Optional
 
 
 class CreateUserReq(BaseModel):
@@ -15,6 +16,7 @@ class LoginUserReq(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
 
 
 class UserOut(BaseModel):
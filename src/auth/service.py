@@ -1,10 +1,13 @@
+import math
 import os
 import time
 from typing import Dict
+from uuid import uuid4
 
 from jose import jwt
 import hashlib
 
+from sqlalchemy import bindparam, delete, update
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
@@ -12,13 +15,36 @@ from fastapi import Request, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from src.auth.exceptions import credentials_exception, user_already_exist_exception, unhandled_exception
-from src.auth.models import User
+from src.auth.denylist import denylist
+from src.auth.models import User, RefreshToken, RevokedToken
 from src.auth.schemas import CreateUserReq
 from src.config import logger
+from src.tracing import tracer
 
 SECRET_KEY = os.getenv("SECRET_KEY", "default-secret-key")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_SECONDS = 30 * 60
+ACCESS_TOKEN_EXPIRE_SECONDS = int(os.getenv("ACCESS_TOKEN_EXPIRE_SECONDS", 10 * 60))
+REFRESH_TOKEN_EXPIRE_SECONDS = int(os.getenv("REFRESH_TOKEN_EXPIRE_SECONDS", 7 * 24 * 60 * 60))
+# Revocations committed up to this long after their `revoked_at`, or stamped by a worker with a clock behind,
+# are still picked up by the next denylist sync.
+DENYLIST_SYNC_OVERLAP_SECONDS = int(os.getenv("DENYLIST_SYNC_OVERLAP_SECONDS", "60"))
+ADMIN_EMAILS = {email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
+
+GET_USER_BY_EMAIL_STMT = select(User).where(User.email == bindparam("email"))
+ROTATE_REFRESH_TOKEN_STMT = (
+    update(RefreshToken)
+    .where(RefreshToken.jti == bindparam("token_jti"), RefreshToken.revoked.is_(False))
+    .values(revoked=True)
+)
+REVOKE_USER_REFRESH_TOKENS_STMT = (
+    update(RefreshToken)
+    .where(RefreshToken.email == bindparam("user_email"), RefreshToken.revoked.is_(False))
+    .values(revoked=True)
+)
+GET_REVOKED_TOKENS_STMT = select(RevokedToken).where(RevokedToken.revoked_at >= bindparam("since"),
+                                                     RevokedToken.expires_at > bindparam("now"))
+DELETE_EXPIRED_REFRESH_TOKENS_STMT = delete(RefreshToken).where(RefreshToken.expires_at <= bindparam("now"))
+DELETE_EXPIRED_REVOKED_TOKENS_STMT = delete(RevokedToken).where(RevokedToken.expires_at <= bindparam("now"))
 
 
 def verify_password(plain_password, hashed_password):
@@ -51,7 +77,7 @@ async def create_user(user: CreateUserReq, db: AsyncSession):
 
 async def authenticate_user(email: str, password: str, db: AsyncSession):
     logger.debug(f"Authenticating user {email}")
-    result = await db.execute(select(User).filter(User.email == email))
+    result = await db.execute(GET_USER_BY_EMAIL_STMT, {"email": email})
     user = result.scalars().first()
     if not user or not verify_password(password, user.hashed_password):
         logger.debug("Wrong password")
@@ -66,24 +92,103 @@ async def authenticate_user(email: str, password: str, db: AsyncSession):
     return user
 
 
-async def refresh_user_token(token: str):
+async def issue_tokens(email: str, db: AsyncSession) -> Dict[str, str]:
+    refresh_jti = uuid4().hex
+    refresh_expires = int(time.time()) + REFRESH_TOKEN_EXPIRE_SECONDS
+    db.add(RefreshToken(jti=refresh_jti, email=email, expires_at=refresh_expires, revoked=False))
+    try:
+        await db.commit()
+    except Exception as e:
+        logger.error(f"Unhandled exception: {e.__class__.__name__}\nDetials: {e}\nReturning 400")
+        raise unhandled_exception
+
+    tokens = sign_jwt(email)
+    tokens["refresh_token"] = encode_jwt({
+        "sub": email,
+        "jti": refresh_jti,
+        "type": "refresh",
+        "expires": refresh_expires,
+    })
+    return tokens
+
+
+async def refresh_user_token(token: str, db: AsyncSession):
     logger.debug("Refreshing token")
     payload = decode_jwt(token)
     email: str = payload.get("sub")
-    if email is None:
-        logger.warning("There is not sub(email) in provided token.")
+    if email is None or payload.get("type") != "refresh":
+        logger.warning("There is not sub(email) in provided token or it is not a refresh token.")
+        raise credentials_exception
+
+    # Only the first use of a refresh token can flip its `revoked` flag, so concurrent refreshes
+    # with the same token cannot both succeed.
+    result = await db.execute(ROTATE_REFRESH_TOKEN_STMT, {"token_jti": payload["jti"]})
+    if result.rowcount != 1:
+        logger.warning(f"Refresh token reuse detected for {email}, revoking all refresh tokens")
+        await db.execute(REVOKE_USER_REFRESH_TOKENS_STMT, {"user_email": email})
+        await db.commit()
         raise credentials_exception
-    new_token = sign_jwt(email)
+
+    new_tokens = await issue_tokens(email, db)
     logger.debug("Token refreshed")
-    return new_token
+    return new_tokens
+
+
+async def revoke_user_tokens(token: str, db: AsyncSession):
+    logger.debug("Revoking tokens")
+    payload = decode_jwt(token)
+    email: str = payload.get("sub")
+    if email is None or payload.get("jti") is None:
+        raise credentials_exception
+
+    db.add(RevokedToken(jti=payload["jti"], expires_at=math.ceil(payload["expires"]), revoked_at=int(time.time())))
+    await db.execute(REVOKE_USER_REFRESH_TOKENS_STMT, {"user_email": email})
+    try:
+        await db.commit()
+    except Exception as e:
+        logger.error(f"Unhandled exception: {e.__class__.__name__}\nDetials: {e}\nReturning 400")
+        raise unhandled_exception
+    denylist.add(payload["jti"], payload["expires"])
+    logger.debug("Tokens revoked")
+
+
+async def sync_denylist(db: AsyncSession, since: int = 0) -> int:
+    """
+    Load tokens revoked since `since` (by any worker) into the in-process denylist.
+
+    Returns the timestamp to pass as `since` on the next call. `revoked_at` is stamped before the revocation commits,
+    so the window overlaps the previous one by `DENYLIST_SYNC_OVERLAP_SECONDS` instead of starting at `since`.
+    """
+    now = int(time.time())
+    result = await db.execute(GET_REVOKED_TOKENS_STMT,
+                              {"since": max(since - DENYLIST_SYNC_OVERLAP_SECONDS, 0), "now": now})
+    for revoked_token in result.scalars().all():
+        denylist.add(revoked_token.jti, revoked_token.expires_at)
+    denylist.purge_expired()
+    return now
+
+
+async def purge_expired_tokens(db: AsyncSession) -> int:
+    """Delete refresh tokens and revocations of tokens that have expired, they can't be used anymore."""
+    now = int(time.time())
+    refresh_tokens = await db.execute(DELETE_EXPIRED_REFRESH_TOKENS_STMT, {"now": now})
+    revoked_tokens = await db.execute(DELETE_EXPIRED_REVOKED_TOKENS_STMT, {"now": now})
+    await db.commit()
+    return refresh_tokens.rowcount + revoked_tokens.rowcount
+
+
+def encode_jwt(payload: dict) -> str:
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
 
 def sign_jwt(user_id: str) -> Dict[str, str]:
     payload = {
         "sub": user_id,
+        "jti": uuid4().hex,
+        "type": "access",
         "expires": time.time() + ACCESS_TOKEN_EXPIRE_SECONDS
     }
-    token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    token = encode_jwt(payload)
 
     return {
         "access_token": token,
@@ -101,15 +206,18 @@ def decode_jwt(token: str) -> dict:
 
 
 class JWTBearer(HTTPBearer):
-    def __init__(self, auto_error: bool = True):
+    def __init__(self, auto_error: bool = True, token_type: str = "access"):
         super(JWTBearer, self).__init__(auto_error=auto_error)
+        self.token_type = token_type
 
     async def __call__(self, request: Request):
         credentials: HTTPAuthorizationCredentials = await super(JWTBearer, self).__call__(request)
         if credentials:
             if not credentials.scheme == "Bearer":
                 raise HTTPException(status_code=403, detail="Invalid authentication scheme.")
-            if not self.verify_jwt(credentials.credentials):
+            with tracer.span("jwt.verify"):
+                is_valid = self.verify_jwt(credentials.credentials)
+            if not is_valid:
                 raise HTTPException(status_code=403, detail="Invalid token or expired token.")
             return credentials.credentials
         else:
@@ -122,7 +230,18 @@ class JWTBearer(HTTPBearer):
             payload = decode_jwt(jwtoken)
         except:
             payload = None
-        if payload:
+        if payload and payload.get("type") == self.token_type and payload.get("jti") not in denylist:
             isTokenValid = True
 
         return isTokenValid
+
+
+class AdminBearer(JWTBearer):
+    """Accepts only access tokens of users listed in `ADMIN_EMAILS`."""
+
+    def verify_jwt(self, jwtoken: str) -> bool:
+        return super(AdminBearer, self).verify_jwt(jwtoken) and decode_jwt(jwtoken).get("sub") in ADMIN_EMAILS
+
+
+def is_admin_token(token: str) -> bool:
+    return AdminBearer(auto_error=False).verify_jwt(token)
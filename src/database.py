@@ -1,12 +1,117 @@
+import time
+from uuid import uuid4
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS, CACHING_DISABLED, NO_CACHE_KEY, NO_DIALECT_SUPPORT
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
 import os
 from sqlalchemy.orm import sessionmaker
 
+from src.tracing import tracer, current_span
+
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Size of SQLAlchemy's per-engine LRU cache of compiled statements.
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "500"))
+# Size of the asyncpg per-connection prepared statement cache, 0 disables it.
+PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("PREPARED_STATEMENT_CACHE_SIZE", "100"))
+# Set when connecting through pgbouncer in transaction pooling mode.
+PGBOUNCER_MODE = os.getenv("PGBOUNCER_MODE", "false").lower() in ("1", "true", "yes")
+
+DB_QUERY_COUNT = Counter('db_queries_total', 'Total number of SQL statements executed')
+DB_COMPILED_CACHE_COUNT = Counter('db_compiled_cache_total',
+                                  'Compiled statement cache lookups by result',
+                                  ['result'])
+DB_QUERY_LATENCY = Histogram('db_query_duration_seconds', 'SQL statement execution time in seconds')
+
+_cache_results = {
+    CACHE_HIT: "hit",
+    CACHE_MISS: "miss",
+    CACHING_DISABLED: "disabled",
+    NO_CACHE_KEY: "no_key",
+    NO_DIALECT_SUPPORT: "no_dialect_support",
+}
+
+
+def prepared_statement_name() -> str:
+    return f"__asyncpg_{uuid4()}__"
+
+
+class TracedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """Records time spent waiting for a pooled connection as a span of the request that asked for it."""
+
+    def _do_get(self):
+        # `_do_get` retries by calling itself, only the outermost call gets a span.
+        span = current_span()
+        if span is None or span.name == "db.pool.checkout":
+            return super()._do_get()
+        with tracer.span("db.pool.checkout", kind="client"):
+            return super()._do_get()
+
+
+def get_engine_options(url: str) -> dict:
+    options = {"echo": True, "future": True, "query_cache_size": QUERY_CACHE_SIZE}
+    if not url.startswith("postgresql+asyncpg"):
+        return options
+
+    connect_args = {"prepared_statement_cache_size": PREPARED_STATEMENT_CACHE_SIZE}
+    if PGBOUNCER_MODE:
+        # pgbouncer may hand each transaction a different server connection, so statement names must never
+        # collide and no prepared statement may be reused by a later transaction: both caches are disabled.
+        connect_args["prepared_statement_name_func"] = prepared_statement_name
+        connect_args["prepared_statement_cache_size"] = 0
+        connect_args["statement_cache_size"] = 0
+        options["poolclass"] = NullPool
+    else:
+        options["poolclass"] = TracedAsyncAdaptedQueuePool
+    options["connect_args"] = connect_args
+    return options
+
+
+def instrument_engine(async_engine):
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_COUNT.inc()
+        cache_hit = getattr(context, "cache_hit", NO_CACHE_KEY)
+        DB_COMPILED_CACHE_COUNT.labels(result=_cache_results.get(cache_hit, "no_key")).inc()
+        context._query_started_at = time.perf_counter()
+        # Statements outside of a request, such as the denylist sync, do not start traces of their own.
+        if current_span() is not None:
+            context._query_span = tracer.start_span(f"db {statement.split(None, 1)[0].upper()}",
+                                                    kind="client",
+                                                    attributes={"db.system": conn.dialect.name,
+                                                                "db.statement": statement[:1000]})
+
+    @event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+    def observe_query(conn, cursor, statement, parameters, context, executemany):
+        finish_query(context)
+
+    @event.listens_for(async_engine.sync_engine, "handle_error")
+    def observe_failed_query(exception_context):
+        if exception_context.execution_context is not None:
+            finish_query(exception_context.execution_context, exception_context.original_exception)
+
+    return async_engine
+
+
+def finish_query(context, exc: Exception = None):
+    started_at = getattr(context, "_query_started_at", None)
+    if started_at is None:
+        return
+    duration = time.perf_counter() - started_at
+    context._query_started_at = None
+    DB_QUERY_LATENCY.observe(duration, exemplar=tracer.exemplar(duration, error=exc is not None))
+    span = getattr(context, "_query_span", None)
+    if span is not None:
+        if exc is not None:
+            span.record_exception(exc)
+        span.end()
+
 
 if DATABASE_URL:
-    engine = create_async_engine(DATABASE_URL, echo=True, future=True)
+    engine = instrument_engine(create_async_engine(DATABASE_URL, **get_engine_options(DATABASE_URL)))
     async_session = sessionmaker(
         bind=engine,
         class_=AsyncSession,
@@ -20,4 +125,3 @@ Base = declarative_base()
 async def get_db():
     async with async_session() as session:
         yield session
-
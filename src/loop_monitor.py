@@ -0,0 +1,151 @@
+import asyncio
+import gc
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import deque
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from src.config import logger
+
+LOOP_MONITOR_INTERVAL_SECONDS = float(os.getenv("LOOP_MONITOR_INTERVAL_SECONDS", "0.1"))
+# Callbacks holding the loop longer than this are reported with their stack.
+LOOP_BLOCK_THRESHOLD_SECONDS = float(os.getenv("LOOP_BLOCK_THRESHOLD_SECONDS", "0.1"))
+LOOP_BLOCK_KEEP = int(os.getenv("LOOP_BLOCK_KEEP", "50"))
+LOOP_BLOCK_STACK_LIMIT = 30
+
+EVENT_LOOP_LAG = Histogram('event_loop_lag_seconds', 'Delay of scheduled event loop callbacks in seconds',
+                           buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+EVENT_LOOP_LAG_LAST = Gauge('event_loop_lag_last_seconds', 'Last measured event loop lag in seconds',
+                            multiprocess_mode='liveall')
+EVENT_LOOP_BLOCKED_COUNT = Counter('event_loop_blocked_total',
+                                   'Callbacks that held the event loop longer than the threshold',
+                                   ['route'])
+EVENT_LOOP_BLOCK_DURATION = Histogram('event_loop_block_duration_seconds',
+                                      'Time the event loop was held by a blocking callback in seconds',
+                                      buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+EVENT_LOOP_TASKS = Gauge('event_loop_tasks', 'Number of tasks not yet finished on the event loop',
+                         multiprocess_mode='livesum')
+GC_PAUSE = Histogram('python_gc_pause_seconds', 'Duration of garbage collector runs in seconds', ['generation'],
+                     buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag, catches callbacks blocking the loop and times garbage collection.
+
+    A probe coroutine sleeps for `interval` and records how late it wakes up, which also serves as a heartbeat.
+    A watchdog thread captures the stack of the loop thread and the route being served when the heartbeat is late
+    by more than `threshold`. The probe reports the block with its duration once the loop is free again.
+    """
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL_SECONDS,
+                 threshold: float = LOOP_BLOCK_THRESHOLD_SECONDS, keep: int = LOOP_BLOCK_KEEP):
+        self.interval = interval
+        self.threshold = threshold
+        self.blocks = deque(maxlen=keep)
+        self.task_scopes: "weakref.WeakKeyDictionary[asyncio.Task, dict]" = weakref.WeakKeyDictionary()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id: Optional[int] = None
+        self._heartbeat = time.monotonic()
+        self._captured: Optional[dict] = None
+        self._gc_started_at = 0.0
+        self._probe: Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._probe = self.loop.create_task(self._run_probe())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        gc.callbacks.append(self._on_gc)
+
+    def stop(self):
+        self._stopped.set()
+        if self._probe is not None:
+            self._probe.cancel()
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+
+    def track_request(self, scope: dict):
+        task = asyncio.current_task()
+        if task is not None:
+            self.task_scopes[task] = scope
+
+    async def _run_probe(self):
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - started_at - self.interval, 0.0)
+            self._heartbeat = now
+            EVENT_LOOP_LAG.observe(lag)
+            EVENT_LOOP_LAG_LAST.set(lag)
+            # Set on every probe rather than through `set_function`, which multiprocess metrics don't support.
+            EVENT_LOOP_TASKS.set(len(asyncio.all_tasks(self.loop)))
+            if lag >= self.threshold:
+                self._report_block(lag)
+            else:
+                self._captured = None
+
+    def _report_block(self, duration: float):
+        block, self._captured = self._captured or {"route": "unknown", "stack": None}, None
+        block = {**block, "duration": duration, "detected_at": time.time()}
+        self.blocks.append(block)
+        EVENT_LOOP_BLOCKED_COUNT.labels(route=block["route"]).inc()
+        EVENT_LOOP_BLOCK_DURATION.observe(duration)
+        logger.warning(f"Event loop blocked for {duration:.3f}s while serving {block['route']}\n"
+                       f"{block['stack'] or 'Stack was not captured'}")
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 2):
+            late = time.monotonic() - self._heartbeat - self.interval
+            if late >= self.threshold and self._captured is None:
+                self._captured = self._capture()
+
+    def _capture(self) -> dict:
+        frame = sys._current_frames().get(self._thread_id)
+        task = asyncio.current_task(self.loop)
+        scope = self.task_scopes.get(task) if task is not None else None
+        route = route_label(scope) if scope is not None else "unknown"
+        stack = "".join(traceback.format_stack(frame, limit=LOOP_BLOCK_STACK_LIMIT)) if frame is not None else None
+        return {"route": route, "stack": stack}
+
+    def _on_gc(self, phase: str, info: dict):
+        if phase == "start":
+            self._gc_started_at = time.perf_counter()
+        elif self._gc_started_at:
+            GC_PAUSE.labels(generation=info["generation"]).observe(time.perf_counter() - self._gc_started_at)
+
+
+def route_label(scope: dict) -> str:
+    # Route templates instead of paths keep the label set of `event_loop_blocked_total` bounded.
+    route = scope.get("route")
+    return f"{scope['method']} {route.path}" if route is not None else f"{scope['method']} unmatched"
+
+
+loop_monitor = LoopMonitor()
+
+
+class LoopMonitorMiddleware:
+    """Records the route served by each task, so blocking callbacks can be attributed to it."""
+
+    def __init__(self, app, monitor: LoopMonitor = loop_monitor):
+        self.app = app
+        self.monitor = monitor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        self.monitor.track_request(scope)
+        await self.app(scope, receive, send)
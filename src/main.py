@@ -1,24 +1,72 @@
-import uvicorn
-from fastapi import FastAPI
+import asyncio
+import os
+
+import time
+
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from prometheus_client import Counter
-from prometheus_client import generate_latest
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, multiprocess
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.openmetrics.exposition import generate_latest as generate_latest_openmetrics, \
+    CONTENT_TYPE_LATEST as CONTENT_TYPE_OPENMETRICS
 from starlette.middleware.base import BaseHTTPMiddleware
 
+from src.admin.profiler import ProfilerMiddleware
+from src.admin.router import router as admin_router
 from src.auth.router import router as auth_router
+from src.auth.service import sync_denylist, purge_expired_tokens
+from src.config import logger
+from src.messages.partitions import MESSAGES_PARTITIONING, create_partitioned_table, migrate_messages_table, \
+    run_partition_maintenance
 from src.messages.router import router as messages_router
-from src.database import Base, engine
+from src.database import Base, engine, async_session
+from src.loop_monitor import loop_monitor, LoopMonitorMiddleware
+from src.tracing import tracer, TracingMiddleware
+
+DENYLIST_SYNC_INTERVAL_SECONDS = float(os.getenv("DENYLIST_SYNC_INTERVAL_SECONDS", "5"))
+TOKEN_PURGE_INTERVAL_SECONDS = float(os.getenv("TOKEN_PURGE_INTERVAL_SECONDS", "3600"))
 
 
 async def init_db():
     async with engine.begin() as conn:
+        if MESSAGES_PARTITIONING and conn.dialect.name == "postgresql":
+            await create_partitioned_table(conn)
+        await migrate_messages_table(conn)
         await conn.run_sync(Base.metadata.create_all)
 
 
+async def run_denylist_sync():
+    since = 0
+    purged_at = 0.0
+    while True:
+        try:
+            async with async_session() as db:
+                since = await sync_denylist(db, since)
+                if time.monotonic() - purged_at >= TOKEN_PURGE_INTERVAL_SECONDS:
+                    purged = await purge_expired_tokens(db)
+                    purged_at = time.monotonic()
+                    logger.debug(f"Purged {purged} expired token rows")
+        except Exception as e:
+            logger.error(f"Denylist sync failed: {e.__class__.__name__}\nDetials: {e}")
+        await asyncio.sleep(DENYLIST_SYNC_INTERVAL_SECONDS)
+
+
 app = FastAPI(
     swagger_ui_parameters={"syntaxHighlight.theme": "obsidian"}
 )
 
+
+async def prepare_db():
+    """
+    Create the schema once before the workers are forked, so they don't race creating it.
+
+    Workers forked afterwards skip `init_db` on startup.
+    """
+    await init_db()
+    # Pooled connections belong to this process and its event loop, workers open their own.
+    await engine.dispose()
+    app.state.db_prepared = True
+
 origins = [
     "http://localhost",
     "http://localhost:3000",
@@ -33,30 +81,73 @@ app.add_middleware(
 )
 
 REQUEST_COUNT = Counter('app_requests_total', 'Total number of requests')
+REQUEST_LATENCY = Histogram('app_request_duration_seconds', 'Request processing time in seconds',
+                            ['method', 'route', 'status'])
 
 
 class MetricsMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request, call_next):
         REQUEST_COUNT.inc()
+        started_at = time.perf_counter()
         response = await call_next(request)
+        duration = time.perf_counter() - started_at
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=response.status_code,
+        ).observe(duration, exemplar=tracer.exemplar(duration, error=response.status_code >= 500))
         return response
 
 
+# Added before MetricsMiddleware so they run inside the task that serves the request.
+app.add_middleware(LoopMonitorMiddleware)
+app.add_middleware(ProfilerMiddleware)
 app.add_middleware(MetricsMiddleware)
+# Outermost, so the server span covers the whole request and is current while metrics are observed.
+app.add_middleware(TracingMiddleware)
 
 app.include_router(auth_router)
 app.include_router(messages_router)
+app.include_router(admin_router)
 
 
 @app.on_event("startup")
 async def on_startup():
-    await init_db()
+    loop_monitor.start()
+    if not getattr(app.state, "db_prepared", False):
+        await init_db()
+    app.state.denylist_sync_task = asyncio.create_task(run_denylist_sync())
+    app.state.partition_maintenance_task = asyncio.create_task(run_partition_maintenance(engine))
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.denylist_sync_task.cancel()
+    app.state.partition_maintenance_task.cancel()
+    loop_monitor.stop()
+
+
+def metrics_registry():
+    # With several workers every worker writes its metrics to `PROMETHEUS_MULTIPROC_DIR`, whichever worker
+    # answers the scrape aggregates all of them.
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
 
 
 @app.get("/metrics")
-async def get_metrics():
-    return generate_latest()
+async def get_metrics(request: Request):
+    registry = metrics_registry()
+    # Exemplars are only part of the OpenMetrics format, which Prometheus asks for when it supports it.
+    if "application/openmetrics-text" in request.headers.get("accept", ""):
+        return Response(generate_latest_openmetrics(registry), media_type=CONTENT_TYPE_OPENMETRICS)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host='localhost', port=8000)
+    from src.server import serve
+    asyncio.run(prepare_db())
+    serve(app)
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+from sqlalchemy import bindparam, func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from src.messages.models import Message
+
+MESSAGE_COUNT_TTL_SECONDS = float(os.getenv("MESSAGE_COUNT_TTL_SECONDS", "60"))
+# Number of creation time ranges whose counts are cached per worker.
+MESSAGE_COUNT_MAX_RANGES = int(os.getenv("MESSAGE_COUNT_MAX_RANGES", "1000"))
+
+COUNT_MESSAGES_STMT = select(func.count()).select_from(Message)
+COUNT_MESSAGES_BETWEEN_STMT = COUNT_MESSAGES_STMT.where(Message.created_at >= bindparam("since"),
+                                                        Message.created_at < bindparam("until"))
+# Row estimate kept by ANALYZE/autovacuum, summed over the partitions of a partitioned table. Never analyzed
+# tables report -1 (or 0 before PostgreSQL 14).
+ESTIMATE_MESSAGES_STMT = text(
+    "SELECT sum(greatest(reltuples, 0))::bigint FROM pg_class "
+    "WHERE oid = CAST(:table AS regclass) "
+    "OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = CAST(:table AS regclass))"
+)
+
+
+class CachedCount:
+    """
+    Exact row count refreshed at most once per TTL and adjusted in between by the writes of this worker.
+
+    Writes of other workers become visible after the next refresh.
+    """
+
+    def __init__(self, stmt, ttl: float = MESSAGE_COUNT_TTL_SECONDS, params: Optional[dict] = None):
+        self.stmt = stmt
+        self.ttl = ttl
+        self.params = params
+        self.value: Optional[int] = None
+        self.refreshed_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def is_fresh(self) -> bool:
+        return self.value is not None and time.monotonic() - self.refreshed_at < self.ttl
+
+    async def get(self, db: AsyncSession) -> int:
+        if self.is_fresh():
+            return self.value
+        # Concurrent callers wait for a single refresh instead of all counting the table.
+        async with self._lock:
+            if not self.is_fresh():
+                result = await db.execute(self.stmt, self.params)
+                self.value = result.scalar()
+                self.refreshed_at = time.monotonic()
+        return self.value
+
+    def add(self, delta: int):
+        if self.value is not None:
+            self.value = max(self.value + delta, 0)
+
+    def invalidate(self):
+        self.value = None
+
+
+def as_utc(value: datetime) -> datetime:
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+class CachedRangeCounts:
+    """
+    A `CachedCount` of the messages created in `[since, until)` for each of the `max_ranges` most recently counted
+    ranges, so paging through a range counts it once per TTL.
+    """
+
+    def __init__(self, stmt, ttl: float = MESSAGE_COUNT_TTL_SECONDS, max_ranges: int = MESSAGE_COUNT_MAX_RANGES):
+        self.stmt = stmt
+        self.ttl = ttl
+        self.max_ranges = max_ranges
+        self._counts: "OrderedDict[Tuple[datetime, datetime], CachedCount]" = OrderedDict()
+
+    async def get(self, db: AsyncSession, since: datetime, until: datetime) -> int:
+        bounds = (as_utc(since), as_utc(until))
+        count = self._counts.get(bounds)
+        if count is None:
+            count = self._counts[bounds] = CachedCount(self.stmt, self.ttl, {"since": since, "until": until})
+            while len(self._counts) > self.max_ranges:
+                self._counts.popitem(last=False)
+        self._counts.move_to_end(bounds)
+        return await count.get(db)
+
+    def add(self, created_at: Optional[datetime], delta: int):
+        if created_at is None:
+            return
+        created_at = as_utc(created_at)
+        for (since, until), count in self._counts.items():
+            if since <= created_at < until:
+                count.add(delta)
+
+    def invalidate(self):
+        self._counts.clear()
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+
+message_count = CachedCount(COUNT_MESSAGES_STMT)
+message_range_counts = CachedRangeCounts(COUNT_MESSAGES_BETWEEN_STMT)
+
+
+async def estimate_count(db: AsyncSession, table: str) -> Optional[int]:
+    """Planner estimate of the number of rows in `table`, `None` when no estimate is available."""
+    if db.bind.dialect.name != "postgresql":
+        return None
+    result = await db.execute(ESTIMATE_MESSAGES_STMT, {"table": table})
+    estimate = result.scalar()
+    return estimate if estimate is not None and estimate > 0 else None
@@ -12,4 +12,29 @@ unhandled_exception = HTTPException(
     status_code=status.HTTP_400_BAD_REQUEST,
     detail=json.dumps("Bad request"),
     headers={"Content-Type": "application/json"},
-)
\ No newline at end of file
+)
+
+invalid_ids_exception = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail=json.dumps("ids must be a comma separated list of at most 100 integers"),
+    headers={"Content-Type": "application/json"},
+)
+
+
+invalid_idempotency_key_exception = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail=json.dumps("Idempotency-Key must be between 1 and 255 characters"),
+    headers={"Content-Type": "application/json"},
+)
+
+idempotency_key_mismatch_exception = HTTPException(
+    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+    detail=json.dumps("Idempotency-Key was already used with a different request"),
+    headers={"Content-Type": "application/json"},
+)
+
+idempotency_conflict_exception = HTTPException(
+    status_code=status.HTTP_409_CONFLICT,
+    detail=json.dumps("A request with this Idempotency-Key is still in progress"),
+    headers={"Content-Type": "application/json"},
+)
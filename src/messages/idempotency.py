@@ -0,0 +1,362 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from prometheus_client import Counter
+from sqlalchemy import bindparam, delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.future import select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from src import database
+from src.auth.service import decode_jwt
+from src.config import logger
+from src.messages.exceptions import idempotency_conflict_exception, idempotency_key_mismatch_exception, \
+    invalid_idempotency_key_exception
+from src.messages.models import IdempotencyKey
+
+# `memory` keeps keys per worker, `database` shares them between workers.
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "memory")
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+# Connections of the `database` backend, kept apart from the pool used by requests.
+IDEMPOTENCY_POOL_SIZE = int(os.getenv("IDEMPOTENCY_POOL_SIZE", "5"))
+# How long a duplicate waits for the request holding its key before giving up with 409.
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+# Claims of the `database` backend expire after this many seconds unless renewed by the worker running the request,
+# which renews them every third of it. Whole seconds, at least 2.
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "30"))
+IDEMPOTENCY_POLL_SECONDS = 0.05
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+IDEMPOTENCY_REQUEST_COUNT = Counter('idempotency_requests_total',
+                                    'Requests with an Idempotency-Key by outcome',
+                                    ['result'])
+
+
+@dataclass
+class StoredResponse:
+    fingerprint: str
+    status_code: Optional[int] = None
+    body: Optional[str] = None
+
+    @property
+    def completed(self) -> bool:
+        return self.status_code is not None
+
+
+class IdempotencyStore(ABC):
+    """
+    Stores the first response for every key and makes duplicates wait while that response is being produced.
+
+    Duplicates in the same worker wait on a future, duplicates in other workers poll the shared backend.
+    Keys are claimed before they are looked up, so a new key costs a single call to the backend.
+    """
+
+    def __init__(self, ttl: int = IDEMPOTENCY_TTL_SECONDS, wait: float = IDEMPOTENCY_WAIT_SECONDS):
+        self.ttl = ttl
+        self.wait = wait
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def begin(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        """
+        Return the stored response for `key`, or `None` when the caller now owns the key and has to call
+        `complete` or `abort`.
+        """
+        deadline = time.monotonic() + self.wait
+        while True:
+            remaining = deadline - time.monotonic()
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(in_flight), max(remaining, 0))
+                except asyncio.TimeoutError:
+                    raise idempotency_conflict_exception
+                continue
+
+            if await self.claim(key, fingerprint):
+                self._in_flight[key] = asyncio.get_running_loop().create_future()
+                return None
+            stored = await self.load(key)
+            if stored is not None and stored.fingerprint != fingerprint:
+                raise idempotency_key_mismatch_exception
+            if stored is not None and stored.completed:
+                return stored
+
+            if remaining <= 0:
+                raise idempotency_conflict_exception
+            await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+    async def complete(self, key: str, response: StoredResponse):
+        try:
+            await self.save(key, response)
+        finally:
+            self._resolve(key)
+
+    async def abort(self, key: str):
+        try:
+            await self.release(key)
+        finally:
+            self._resolve(key)
+
+    def _resolve(self, key: str):
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    @abstractmethod
+    async def load(self, key: str) -> Optional[StoredResponse]:
+        """Return the claim or response stored for `key`, `None` when there is none or it expired."""
+
+    @abstractmethod
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        """Store an uncompleted entry for `key` unless one exists, return whether it was stored."""
+
+    @abstractmethod
+    async def save(self, key: str, response: StoredResponse):
+        """Replace the claim of `key` with its response."""
+
+    @abstractmethod
+    async def release(self, key: str):
+        """Drop the claim of `key`, so the next request with it runs again."""
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """
+    Keeps at most `max_keys` keys in this worker, evicting expired and then least recently used ones.
+
+    Claims of requests still running are never evicted, since a duplicate would run the request again. The store
+    grows past `max_keys` when that many requests are in flight.
+    """
+
+    def __init__(self, max_keys: int = IDEMPOTENCY_MAX_KEYS, **kwargs):
+        super(MemoryIdempotencyStore, self).__init__(**kwargs)
+        self.max_keys = max_keys
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def load(self, key: str) -> Optional[StoredResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, stored = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return stored
+
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        if await self.load(key) is not None:
+            return False
+        self._store(key, StoredResponse(fingerprint))
+        return True
+
+    async def save(self, key: str, response: StoredResponse):
+        self._store(key, response)
+
+    async def release(self, key: str):
+        self._entries.pop(key, None)
+
+    def _store(self, key: str, stored: StoredResponse):
+        now = time.monotonic()
+        self._entries[key] = (now + self.ttl, stored)
+        self._entries.move_to_end(key)
+        in_flight = 0
+        while len(self._entries) > in_flight:
+            oldest_key, (expires_at, oldest) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_keys:
+                break
+            if not oldest.completed:
+                self._entries.move_to_end(oldest_key)
+                in_flight += 1
+                continue
+            del self._entries[oldest_key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def create_store_engine(pool_size: int = IDEMPOTENCY_POOL_SIZE):
+    options = database.get_engine_options(database.DATABASE_URL)
+    if options.get("poolclass") is not NullPool:
+        options.update(pool_size=pool_size, max_overflow=0)
+    return database.instrument_engine(create_async_engine(database.DATABASE_URL, **options))
+
+
+class DatabaseIdempotencyStore(IdempotencyStore):
+    """
+    Shares keys between workers through the `idempotency_keys` table, expired rows are purged while claiming.
+
+    A claim is leased for `lease` seconds and renewed while its request runs, however long that takes, so only
+    claims of workers that died expire. Uses an engine of its own, created on first use, so keyed requests holding
+    a connection of the request pool never wait on that pool for a second one.
+    """
+
+    GET_KEY_STMT = select(IdempotencyKey).where(IdempotencyKey.key == bindparam("idempotency_key"))
+    DELETE_EXPIRED_KEY_STMT = delete(IdempotencyKey).where(IdempotencyKey.key == bindparam("idempotency_key"),
+                                                           IdempotencyKey.expires_at <= bindparam("now"))
+    DELETE_EXPIRED_STMT = delete(IdempotencyKey).where(IdempotencyKey.expires_at <= bindparam("now"))
+    DELETE_KEY_STMT = delete(IdempotencyKey).where(IdempotencyKey.key == bindparam("idempotency_key"))
+    RENEW_CLAIM_STMT = (
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == bindparam("idempotency_key"), IdempotencyKey.status_code.is_(None))
+        .values(expires_at=bindparam("claim_expires_at"))
+    )
+    SAVE_RESPONSE_STMT = (
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == bindparam("idempotency_key"))
+        .values(fingerprint=bindparam("response_fingerprint"), status_code=bindparam("response_status_code"),
+                body=bindparam("response_body"), expires_at=bindparam("response_expires_at"))
+    )
+    PURGE_INTERVAL_SECONDS = 60
+
+    def __init__(self, session_factory=None, lease: int = IDEMPOTENCY_LEASE_SECONDS, **kwargs):
+        super(DatabaseIdempotencyStore, self).__init__(**kwargs)
+        self._session_factory = session_factory
+        self.lease = max(lease, 2)
+        self._purged_at = 0.0
+        self._renewals: Dict[str, asyncio.Event] = {}
+        self._renewal_tasks: Set[asyncio.Task] = set()
+
+    def session(self):
+        if self._session_factory is None:
+            self._session_factory = sessionmaker(bind=create_store_engine(), class_=AsyncSession,
+                                                 expire_on_commit=False)
+        return self._session_factory()
+
+    async def load(self, key: str) -> Optional[StoredResponse]:
+        async with self.session() as db:
+            row = (await db.execute(self.GET_KEY_STMT, {"idempotency_key": key})).scalars().first()
+        if row is None or row.expires_at <= time.time():
+            return None
+        return StoredResponse(row.fingerprint, row.status_code, row.body)
+
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        now = int(time.time())
+        async with self.session() as db:
+            if time.monotonic() - self._purged_at > self.PURGE_INTERVAL_SECONDS:
+                self._purged_at = time.monotonic()
+                await db.execute(self.DELETE_EXPIRED_STMT, {"now": now})
+            else:
+                await db.execute(self.DELETE_EXPIRED_KEY_STMT, {"idempotency_key": key, "now": now})
+            db.add(IdempotencyKey(key=key, fingerprint=fingerprint, expires_at=now + self.lease))
+            try:
+                await db.commit()
+            except IntegrityError:
+                return False
+        self._start_renewal(key)
+        return True
+
+    def _start_renewal(self, key: str):
+        stopped = asyncio.Event()
+        self._renewals[key] = stopped
+        task = asyncio.create_task(self._renew(key, stopped))
+        self._renewal_tasks.add(task)
+        task.add_done_callback(self._renewal_tasks.discard)
+
+    def _stop_renewal(self, key: str):
+        # The renewal only touches uncompleted claims, so one still running when the key is saved or released
+        # changes nothing.
+        stopped = self._renewals.pop(key, None)
+        if stopped is not None:
+            stopped.set()
+
+    async def _renew(self, key: str, stopped: asyncio.Event):
+        while True:
+            try:
+                await asyncio.wait_for(stopped.wait(), self.lease / 3)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                async with self.session() as db:
+                    result = await db.execute(self.RENEW_CLAIM_STMT, {
+                        "idempotency_key": key,
+                        "claim_expires_at": int(time.time()) + self.lease,
+                    })
+                    await db.commit()
+                if result.rowcount == 0:
+                    logger.warning(f"Claim of idempotency key {key} was lost while its request was running")
+                    return
+            except Exception as e:
+                logger.error(f"Renewing claim of idempotency key {key} failed: {e.__class__.__name__}\nDetials: {e}")
+
+    async def save(self, key: str, response: StoredResponse):
+        self._stop_renewal(key)
+        expires_at = int(time.time()) + self.ttl
+        async with self.session() as db:
+            result = await db.execute(self.SAVE_RESPONSE_STMT, {
+                "idempotency_key": key,
+                "response_fingerprint": response.fingerprint,
+                "response_status_code": response.status_code,
+                "response_body": response.body,
+                "response_expires_at": expires_at,
+            })
+            # The claim expired and was purged while the request ran.
+            if result.rowcount == 0:
+                db.add(IdempotencyKey(key=key, fingerprint=response.fingerprint, status_code=response.status_code,
+                                      body=response.body, expires_at=expires_at))
+            await db.commit()
+
+    async def release(self, key: str):
+        self._stop_renewal(key)
+        async with self.session() as db:
+            await db.execute(self.DELETE_KEY_STMT, {"idempotency_key": key})
+            await db.commit()
+
+
+def create_store(backend: str = IDEMPOTENCY_BACKEND) -> IdempotencyStore:
+    if backend == "database":
+        return DatabaseIdempotencyStore()
+    return MemoryIdempotencyStore()
+
+
+idempotency_store = create_store()
+
+
+async def run_idempotent(request: Request, idempotency_key: Optional[str], handler: Callable[[], Awaitable],
+                         response_model, store: Optional[IdempotencyStore] = None):
+    """
+    Run `handler` once per `Idempotency-Key` and replay its response for repeated keys.
+
+    Keys are scoped to the user, method and path. Reusing a key with a different request body returns
+    `422 Unprocessable Entity`, a duplicate still waiting for the first request after the wait period gets
+    `409 Conflict`. Requests without a key run `handler` as usual.
+    """
+    if idempotency_key is None:
+        return await handler()
+    if not idempotency_key or len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise invalid_idempotency_key_exception
+
+    store = idempotency_store if store is None else store
+    _, _, token = request.headers.get("authorization", "").partition(" ")
+    user = decode_jwt(token).get("sub", "")
+    key = f"{user}:{request.method}:{request.url.path}:{idempotency_key}"
+    fingerprint = hashlib.sha256(await request.body()).hexdigest()
+
+    stored = await store.begin(key, fingerprint)
+    if stored is not None:
+        IDEMPOTENCY_REQUEST_COUNT.labels(result="replayed").inc()
+        return JSONResponse(json.loads(stored.body), status_code=stored.status_code,
+                            headers={"Idempotent-Replayed": "true"})
+
+    IDEMPOTENCY_REQUEST_COUNT.labels(result="executed").inc()
+    try:
+        result = await handler()
+        body = jsonable_encoder(response_model.model_validate(result, from_attributes=True))
+    except BaseException:
+        await store.abort(key)
+        raise
+    await store.complete(key, StoredResponse(fingerprint, 200, json.dumps(body)))
+    return JSONResponse(body)
@@ -0,0 +1,84 @@
+import asyncio
+import contextvars
+import os
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Set
+
+from prometheus_client import Histogram
+
+from src.tracing import tracer, current_span
+
+MESSAGE_LOADER_WINDOW_SECONDS = float(os.getenv("MESSAGE_LOADER_WINDOW_SECONDS", "0.002"))
+MESSAGE_LOADER_MAX_BATCH_SIZE = int(os.getenv("MESSAGE_LOADER_MAX_BATCH_SIZE", "100"))
+
+LOADER_BATCH_SIZE = Histogram('loader_batch_size', 'Number of keys fetched by one batched query', ['loader'],
+                              buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+LOADER_LATENCY = Histogram('loader_latency_seconds', 'Time from the first key of a batch to its result',
+                           ['loader'])
+
+
+class BatchLoader:
+    """
+    Merges concurrent single-key lookups into one call of `batch_fn`.
+
+    Keys requested within `window` seconds of the first one are fetched together, a batch reaching `max_batch_size`
+    is fetched right away. `batch_fn` receives the distinct keys and returns a dict of the keys it found.
+
+    The batch runs outside of the context of any caller, since it works for all of them. Traced callers get a
+    `loader.wait` span covering the wait for their key instead.
+    """
+
+    def __init__(self, name: str, batch_fn: Callable[[List[Hashable]], Awaitable[Dict]],
+                 window: float = MESSAGE_LOADER_WINDOW_SECONDS, max_batch_size: int = MESSAGE_LOADER_MAX_BATCH_SIZE):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: Dict[Hashable, List[asyncio.Future]] = {}
+        self._started_at = 0.0
+        self._timer = None
+        # The loop only keeps weak references to tasks, a batch nobody refers to could be collected mid-run.
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, key: Hashable):
+        loop = asyncio.get_running_loop()
+        if not self._pending:
+            self._started_at = time.perf_counter()
+            self._timer = loop.call_later(self.window, self._dispatch)
+        future = loop.create_future()
+        self._pending.setdefault(key, []).append(future)
+        if len(self._pending) >= self.max_batch_size:
+            self._dispatch()
+        if current_span() is None:
+            return await future
+        with tracer.span("loader.wait", attributes={"loader": self.name, "loader.key": str(key)}):
+            return await future
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, started_at = self._pending, self._started_at
+        self._pending = {}
+        task = asyncio.get_running_loop().create_task(self._run(batch, started_at), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: Dict[Hashable, List[asyncio.Future]], started_at: float):
+        LOADER_BATCH_SIZE.labels(loader=self.name).observe(len(batch))
+        try:
+            results = await self.batch_fn(list(batch))
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        finally:
+            LOADER_LATENCY.labels(loader=self.name).observe(time.perf_counter() - started_at)
+        for key, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(key))
@@ -1,9 +1,28 @@
-from sqlalchemy import Column, Integer, String
+from datetime import datetime, timezone
+
+from sqlalchemy import Column, DateTime, Integer, String, Text
 from src.database import Base
 
 
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
 class Message(Base):
     __tablename__ = "messages"
 
+    # On PostgreSQL with partitioning enabled the table is created by `src.messages.partitions` with
+    # `(id, created_at)` as primary key, the ORM keeps identifying messages by `id` alone.
     id = Column(Integer, primary_key=True, index=True)
     text = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, index=True, default=utcnow)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=True)
+    body = Column(Text, nullable=True)
+    expires_at = Column(Integer, index=True, nullable=False)
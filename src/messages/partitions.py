@@ -0,0 +1,198 @@
+import asyncio
+import csv
+import gzip
+import os
+import re
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from src.config import logger
+from src.messages.models import utcnow
+
+MESSAGES_PARTITIONING = os.getenv("MESSAGES_PARTITIONING", "true").lower() in ("1", "true", "yes")
+MESSAGES_PARTITIONS_AHEAD = int(os.getenv("MESSAGES_PARTITIONS_AHEAD", "3"))
+# Months of messages kept in the database, 0 keeps everything.
+MESSAGES_RETENTION_MONTHS = int(os.getenv("MESSAGES_RETENTION_MONTHS", "0"))
+MESSAGES_ARCHIVE_DIR = os.getenv("MESSAGES_ARCHIVE_DIR", "archive")
+MESSAGES_PARTITION_MAINTENANCE_SECONDS = float(os.getenv("MESSAGES_PARTITION_MAINTENANCE_SECONDS", "3600"))
+
+# Arbitrary key, taken so only one worker maintains partitions at a time.
+PARTITION_MAINTENANCE_LOCK_ID = 7_312_024
+PARTITION_NAME_RE = re.compile(r"^messages_p(\d{4})(\d{2})$")
+ARCHIVE_BATCH_SIZE = 1000
+
+CREATE_PARTITIONED_TABLE_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id SERIAL NOT NULL,
+        text VARCHAR NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_messages_id ON messages (id)",
+    "CREATE INDEX IF NOT EXISTS ix_messages_created_at ON messages (created_at)",
+    "CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT",
+]
+# Tables created before messages had a creation time get the time of the migration for their existing rows. On
+# PostgreSQL the constant `now()` default doesn't rewrite the table.
+ADD_CREATED_AT_PG_DDL = [
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+    "CREATE INDEX IF NOT EXISTS ix_messages_created_at ON messages (created_at)",
+]
+# SQLite only accepts constant defaults when adding a column, the current time is inlined instead.
+ADD_CREATED_AT_SQLITE_DDL = [
+    "ALTER TABLE messages ADD COLUMN created_at DATETIME NOT NULL DEFAULT '{now:%Y-%m-%d %H:%M:%S.%f}'",
+    "CREATE INDEX IF NOT EXISTS ix_messages_created_at ON messages (created_at)",
+]
+IS_PARTITIONED_STMT = text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('messages')")
+LIST_PARTITION_TABLES_STMT = text(
+    "SELECT relname, relispartition FROM pg_class WHERE relkind = 'r' AND relname ~ '^messages_p[0-9]{6}$'"
+)
+
+
+def month_start(year: int, month: int) -> datetime:
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return datetime(year, month, 1, tzinfo=timezone.utc)
+
+
+def partition_bounds(now: datetime, ahead: int = MESSAGES_PARTITIONS_AHEAD) -> List[Tuple[str, datetime, datetime]]:
+    """Monthly partitions `(name, start, end)` from the current month up to `ahead` months ahead."""
+    partitions = []
+    for offset in range(ahead + 1):
+        start = month_start(now.year, now.month + offset)
+        end = month_start(start.year, start.month + 1)
+        partitions.append((f"messages_p{start:%Y%m}", start, end))
+    return partitions
+
+
+def expired_partitions(names: List[str], now: datetime, retention_months: int = MESSAGES_RETENTION_MONTHS) -> List[str]:
+    """Partitions whose whole month is older than the retention period."""
+    if retention_months <= 0:
+        return []
+    cutoff = month_start(now.year, now.month - retention_months)
+    expired = []
+    for name in names:
+        match = PARTITION_NAME_RE.match(name)
+        if match and month_start(int(match.group(1)), int(match.group(2)) + 1) <= cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+
+async def is_partitioned(conn: AsyncConnection) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    return bool((await conn.execute(IS_PARTITIONED_STMT)).scalar())
+
+
+def messages_columns(sync_conn) -> Optional[List[str]]:
+    inspector = inspect(sync_conn)
+    if not inspector.has_table("messages"):
+        return None
+    return [column["name"] for column in inspector.get_columns("messages")]
+
+
+async def migrate_messages_table(conn: AsyncConnection) -> bool:
+    """Add `created_at` and its index to a `messages` table created before it existed, `True` when it was added."""
+    columns = await conn.run_sync(messages_columns)
+    if columns is None or "created_at" in columns:
+        return False
+    if conn.dialect.name == "postgresql":
+        ddl = ADD_CREATED_AT_PG_DDL
+    else:
+        ddl = [statement.format(now=utcnow()) for statement in ADD_CREATED_AT_SQLITE_DDL]
+    for statement in ddl:
+        await conn.execute(text(statement))
+    logger.info("Added created_at to existing table messages")
+    return True
+
+
+async def create_partitioned_table(conn: AsyncConnection):
+    """Create `messages` as a range partitioned table unless it already exists."""
+    partitioned = (await conn.execute(IS_PARTITIONED_STMT)).scalar()
+    if partitioned is False:
+        logger.warning("Table messages exists and is not partitioned, it has to be partitioned manually")
+        return
+    for ddl in CREATE_PARTITIONED_TABLE_DDL:
+        await conn.execute(text(ddl))
+    await ensure_partitions(conn)
+
+
+async def ensure_partitions(conn: AsyncConnection, now: Optional[datetime] = None):
+    for name, start, end in partition_bounds(now or utcnow()):
+        await conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+
+
+def write_archive(path: str, rows: List[tuple], mode: str):
+    with gzip.open(path, mode, newline="") as archive:
+        csv.writer(archive).writerows(rows)
+
+
+async def archive_partition(conn: AsyncConnection, name: str, archive_dir: str = MESSAGES_ARCHIVE_DIR) -> str:
+    """Write all rows of a detached partition to `<archive_dir>/<name>.csv.gz` without blocking the loop on disk IO."""
+    await asyncio.to_thread(os.makedirs, archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    partial_path = f"{path}.partial"
+    await asyncio.to_thread(write_archive, partial_path, [("id", "text", "created_at")], "wt")
+    result = await conn.stream(text(f"SELECT id, text, created_at FROM {name} ORDER BY created_at, id"))
+    async for rows in result.partitions(ARCHIVE_BATCH_SIZE):
+        await asyncio.to_thread(write_archive, partial_path, [tuple(row) for row in rows], "at")
+    await asyncio.to_thread(os.replace, partial_path, path)
+    return path
+
+
+async def apply_retention(conn: AsyncConnection, now: Optional[datetime] = None) -> List[str]:
+    """
+    Detach, archive and drop partitions older than the retention period.
+
+    Every step is committed on its own. Partitions left detached by an interrupted run are picked up again, and a
+    partition is only dropped after its archive was completely written.
+    """
+    tables = {name: attached for name, attached in (await conn.execute(LIST_PARTITION_TABLES_STMT)).all()}
+    await conn.commit()
+    archived = []
+    for name in expired_partitions(list(tables), now or utcnow()):
+        # Detaching locks the parent table, so it is committed right away instead of being held while archiving.
+        if tables[name]:
+            await conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+            await conn.commit()
+        path = await archive_partition(conn, name)
+        await conn.execute(text(f"DROP TABLE {name}"))
+        await conn.commit()
+        logger.info(f"Partition {name} archived to {path} and dropped")
+        archived.append(name)
+    return archived
+
+
+async def maintain_partitions(engine: AsyncEngine):
+    async with engine.connect() as conn:
+        if not await is_partitioned(conn):
+            return
+        locked = (await conn.execute(text("SELECT pg_try_advisory_lock(:id)"),
+                                     {"id": PARTITION_MAINTENANCE_LOCK_ID})).scalar()
+        await conn.commit()
+        if not locked:
+            return
+        try:
+            await ensure_partitions(conn)
+            await conn.commit()
+            await apply_retention(conn)
+        finally:
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": PARTITION_MAINTENANCE_LOCK_ID})
+            await conn.commit()
+
+
+async def run_partition_maintenance(engine: AsyncEngine):
+    while True:
+        try:
+            await maintain_partitions(engine)
+        except Exception as e:
+            logger.error(f"Partition maintenance failed: {e.__class__.__name__}\nDetials: {e}")
+        await asyncio.sleep(MESSAGES_PARTITION_MAINTENANCE_SECONDS)
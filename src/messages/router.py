@@ -1,19 +1,36 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from datetime import datetime
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from slowapi import Limiter
 from slowapi.util import get_remote_address
-from typing import List
+from typing import List, Literal, Optional, Union
 
 from src.auth.service import JWTBearer
 from src.database import get_db
-from src.messages.schemas import MessageReq, MessageResponse, MessageUpdate
-from src.messages.service import create_message, get_messages, get_message, update_message, delete_message
+from src.messages.exceptions import invalid_ids_exception
+from src.messages.idempotency import run_idempotent
+from src.messages.schemas import MessageReq, MessageResponse, MessageUpdate, MessagePage
+from src.messages.service import create_message, get_messages, load_message, update_message, delete_message, \
+    count_messages, get_messages_by_ids
 
 router = APIRouter()
 limiter = Limiter(key_func=get_remote_address)
 
 prefix = "messages"
 
+MAX_IDS = 100
+
+
+def parse_ids(ids: str) -> List[int]:
+    try:
+        message_ids = [int(message_id) for message_id in ids.split(",") if message_id.strip()]
+    except ValueError:
+        raise invalid_ids_exception
+    if not message_ids or len(message_ids) > MAX_IDS:
+        raise invalid_ids_exception
+    return message_ids
+
 
 @router.post(f"/{prefix}/",
              dependencies=[Depends(JWTBearer())],
@@ -21,11 +38,15 @@ prefix = "messages"
              summary="Create a new message",
              tags=["Messages"])
 @limiter.limit("30/minute")
-async def create_message_route(request: Request, message: MessageReq, db: AsyncSession = Depends(get_db)):
+async def create_message_route(request: Request, message: MessageReq,
+                               idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+                               db: AsyncSession = Depends(get_db)):
     """
     Create a new message with the given text.
 
     - **message**: Message content provided by the user.
+    - **Idempotency-Key** (header, optional): Retries with the same key return the first response instead of
+      creating another message. A retry arriving while the first request is still running waits for it.
     - **Returns**: Created message with `id` and `text`.
 
     Example:
@@ -35,21 +56,32 @@ async def create_message_route(request: Request, message: MessageReq, db: AsyncS
     }
     ```
     """
-    return await create_message(db=db, message=message)
+    return await run_idempotent(request, idempotency_key, lambda: create_message(db=db, message=message),
+                                MessageResponse)
 
 
 @router.get(f"/{prefix}/",
             dependencies=[Depends(JWTBearer())],
-            response_model=List[MessageResponse],
+            response_model=Union[List[MessageResponse], MessagePage],
             summary="Retrieve all messages",
             tags=["Messages"])
 @limiter.limit("60/minute")
-async def get_messages_route(request: Request, skip: int = 0, limit: int = 10, db: AsyncSession = Depends(get_db)):
+async def get_messages_route(request: Request, skip: int = 0, limit: int = 10,
+                             include_total: Optional[Literal["approximate", "exact"]] = None,
+                             ids: Optional[str] = None,
+                             since: Optional[datetime] = None, until: Optional[datetime] = None,
+                             db: AsyncSession = Depends(get_db)):
     """
     Retrieve a list of all messages.
 
     - **skip**: Number of items to skip for pagination.
     - **limit**: Maximum number of messages to return.
+    - **include_total**: `approximate` or `exact` to wrap the page in an object with the total number of messages.
+    - **ids**: Comma separated list of up to 100 message IDs to fetch in one query instead of a page.
+      Messages are returned in the requested order, missing IDs are skipped. `skip`, `limit` and `include_total`
+      are ignored.
+    - **since**, **until**: Only return messages created in `[since, until)`, ordered by creation time.
+      Such totals are always exact.
 
     Example request:
     ```
@@ -61,16 +93,47 @@ async def get_messages_route(request: Request, skip: int = 0, limit: int = 10, d
     [
         {
             "id": 1,
-            "text": "Hello World!"
+            "text": "Hello World!",
+            "created_at": "2024-09-12T10:00:00Z"
         },
         {
             "id": 2,
-            "text": "Another message"
+            "text": "Another message",
+            "created_at": "2024-09-12T10:05:00Z"
         }
     ]
     ```
+
+    Example request with a total:
+    ```
+    GET /messages?skip=0&limit=10&include_total=approximate
+    ```
+
+    Example response:
+    ```
+    {
+        "items": [
+            {
+                "id": 1,
+                "text": "Hello World!",
+                "created_at": "2024-09-12T10:00:00Z"
+            }
+        ],
+        "total": 1520332,
+        "total_kind": "approximate"
+    }
+    ```
+
+    An approximate total comes from PostgreSQL planner statistics. An exact total is cached for a short time.
+    When no estimate is available the exact total is returned, `total_kind` states which one it is.
     """
-    return await get_messages(db=db, skip=skip, limit=limit)
+    if ids is not None:
+        return await get_messages_by_ids(db=db, message_ids=parse_ids(ids))
+    messages = await get_messages(db=db, skip=skip, limit=limit, since=since, until=until)
+    if include_total is None:
+        return messages
+    total, total_kind = await count_messages(db=db, kind=include_total, since=since, until=until)
+    return {"items": messages, "total": total, "total_kind": total_kind}
 
 
 @router.get(f"/{prefix}/{{message_id}}",
@@ -79,7 +142,7 @@ async def get_messages_route(request: Request, skip: int = 0, limit: int = 10, d
             summary="Get a message by ID",
             tags=["Messages"])
 @limiter.limit("60/minute")
-async def get_message_route(request: Request, message_id: int, db: AsyncSession = Depends(get_db)):
+async def get_message_route(request: Request, message_id: int):
     """
     Retrieve a single message by its ID.
 
@@ -94,13 +157,17 @@ async def get_message_route(request: Request, message_id: int, db: AsyncSession
     ```
     {
         "id": 1,
-        "text": "Hello World!"
+        "text": "Hello World!",
+        "created_at": "2024-09-12T10:00:00Z"
     }
     ```
 
     If the message does not exist, a `404 Not Found` error is returned.
+
+    Concurrent lookups in the same worker are merged into a single query, so clients can fetch many messages
+    in parallel without holding a database connection each.
     """
-    return await get_message(db=db, message_id=message_id)
+    return await load_message(message_id=message_id)
 
 
 @router.put(f"/{prefix}/{{message_id}}",
@@ -110,12 +177,14 @@ async def get_message_route(request: Request, message_id: int, db: AsyncSession
             tags=["Messages"])
 @limiter.limit("15/minute")
 async def update_message_route(request: Request, message_id: int, message: MessageUpdate,
+                               idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
                                db: AsyncSession = Depends(get_db)):
     """
     Update an existing message by its ID.
 
     - **message_id**: The ID of the message to update.
     - **message**: New text for the message.
+    - **Idempotency-Key** (header, optional): Retries with the same key return the first response.
 
     Example request:
     ```
@@ -127,7 +196,9 @@ async def update_message_route(request: Request, message_id: int, message: Messa
 
     If the message does not exist, a `404 Not Found` error is returned.
     """
-    return await update_message(db=db, message_id=message_id, message=message)
+    return await run_idempotent(request, idempotency_key,
+                                lambda: update_message(db=db, message_id=message_id, message=message),
+                                MessageResponse)
 
 
 @router.delete(f"/{prefix}/{{message_id}}",
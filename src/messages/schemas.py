@@ -1,5 +1,7 @@
+from datetime import datetime
+
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Literal, Optional
 
 
 class MessageReq(BaseModel):
@@ -13,6 +15,13 @@ class MessageUpdate(BaseModel):
 class MessageResponse(BaseModel):
     id: int
     text: str
+    created_at: datetime
 
     class Config:
         orm_mode = True
+
+
+class MessagePage(BaseModel):
+    items: List[MessageResponse]
+    total: int
+    total_kind: Literal["approximate", "exact"]
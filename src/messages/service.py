@@ -1,13 +1,40 @@
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
 from fastapi import HTTPException
-from sqlalchemy import update
+from sqlalchemy import ARRAY, Integer, any_, bindparam, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
+from src import database
+from src.messages.counts import message_count, message_range_counts, estimate_count
 from src.messages.exceptions import message_not_found_exception, unhandled_exception
+from src.messages.loader import BatchLoader
 from src.messages.models import Message
 from src.messages.schemas import MessageReq, MessageUpdate
 from src.config import logger
 
+# Hot-path statements are built once so SQLAlchemy reuses their memoized cache key
+# and compiled form; per-call values are passed as bound parameters.
+GET_MESSAGES_STMT = select(Message).offset(bindparam("skip")).limit(bindparam("limit"))
+# Plain range predicates on the partition key let PostgreSQL prune partitions outside [since, until).
+CREATED_BETWEEN = (Message.created_at >= bindparam("since"), Message.created_at < bindparam("until"))
+GET_MESSAGES_BETWEEN_STMT = (
+    select(Message)
+    .where(*CREATED_BETWEEN)
+    .order_by(Message.created_at, Message.id)
+    .offset(bindparam("skip"))
+    .limit(bindparam("limit"))
+)
+MIN_CREATED_AT = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MAX_CREATED_AT = datetime(9999, 1, 1, tzinfo=timezone.utc)
+# Lookups by id carry no creation time, so on a partitioned table they probe the id index of every partition
+# instead of being pruned to one. Retention keeps the number of partitions, and so of probes, bounded.
+GET_MESSAGE_STMT = select(Message).where(Message.id == bindparam("message_id")).limit(1)
+# PostgreSQL gets a single array parameter so every batch size shares one prepared statement.
+GET_MESSAGES_BY_IDS_PG_STMT = select(Message).where(Message.id == any_(bindparam("message_ids", type_=ARRAY(Integer))))
+GET_MESSAGES_BY_IDS_STMT = select(Message).where(Message.id.in_(bindparam("message_ids", expanding=True)))
+
 
 async def create_message(db: AsyncSession, message: MessageReq):
     try:
@@ -15,6 +42,8 @@ async def create_message(db: AsyncSession, message: MessageReq):
         db.add(db_message)
         await db.commit()
         await db.refresh(db_message)
+        message_count.add(1)
+        message_range_counts.add(db_message.created_at, 1)
         logger.info(f"Message created with ID {db_message.id}")
         return db_message
     except Exception as e:
@@ -23,9 +52,18 @@ async def create_message(db: AsyncSession, message: MessageReq):
         raise unhandled_exception
 
 
-async def get_messages(db: AsyncSession, skip: int = 0, limit: int = 10):
+def created_between(since: Optional[datetime], until: Optional[datetime]) -> dict:
+    return {"since": since or MIN_CREATED_AT, "until": until or MAX_CREATED_AT}
+
+
+async def get_messages(db: AsyncSession, skip: int = 0, limit: int = 10,
+                       since: Optional[datetime] = None, until: Optional[datetime] = None):
     try:
-        result = await db.execute(select(Message).offset(skip).limit(limit))
+        if since is None and until is None:
+            result = await db.execute(GET_MESSAGES_STMT, {"skip": skip, "limit": limit})
+        else:
+            result = await db.execute(GET_MESSAGES_BETWEEN_STMT,
+                                      {"skip": skip, "limit": limit, **created_between(since, until)})
         messages = result.scalars().all()
         logger.info(f"Retrieved {len(messages)} messages")
         return messages
@@ -36,9 +74,65 @@ async def get_messages(db: AsyncSession, skip: int = 0, limit: int = 10):
         raise unhandled_exception
 
 
+async def get_messages_by_ids(db: AsyncSession, message_ids: List[int]):
+    try:
+        stmt = GET_MESSAGES_BY_IDS_PG_STMT if db.bind.dialect.name == "postgresql" else GET_MESSAGES_BY_IDS_STMT
+        result = await db.execute(stmt, {"message_ids": list(set(message_ids))})
+        found = {message.id: message for message in result.scalars().all()}
+        messages = [found[message_id] for message_id in message_ids if message_id in found]
+        logger.info(f"Retrieved {len(messages)} of {len(message_ids)} requested messages")
+        return messages
+    except Exception as e:
+        logger.error(f"Unhandled exception: {e.__class__.__name__}\nreturning 400")
+        logger.error(f"Database error occurred while getting messages by IDs: {str(e)}")
+        raise unhandled_exception
+
+
+async def fetch_messages_by_ids(message_ids: List[int]):
+    async with database.async_session() as db:
+        return {message.id: message for message in await get_messages_by_ids(db, message_ids)}
+
+
+message_loader = BatchLoader("messages", fetch_messages_by_ids)
+
+
+async def load_message(message_id: int):
+    """Same as `get_message`, but concurrent lookups are merged into one query on a shared connection."""
+    message = await message_loader.load(message_id)
+    if message is None:
+        logger.warning(f"Message with ID {message_id} not found")
+        raise message_not_found_exception
+    logger.info(f"Message with ID {message_id} retrieved")
+    return message
+
+
+async def count_messages(db: AsyncSession, kind: str = "exact",
+                         since: Optional[datetime] = None, until: Optional[datetime] = None) -> Tuple[int, str]:
+    """
+    Total number of messages and the kind of count returned.
+
+    An approximate count comes from planner statistics and falls back to the cached exact count when those
+    are not available, for example on SQLite. Counts limited to a creation time range are always exact, cached
+    per range the same way and only scan the partitions of that range.
+    """
+    try:
+        if since is not None or until is not None:
+            bounds = created_between(since, until)
+            return await message_range_counts.get(db, bounds["since"], bounds["until"]), "exact"
+        if kind == "approximate":
+            estimate = await estimate_count(db, Message.__tablename__)
+            if estimate is not None:
+                return estimate, "approximate"
+        return await message_count.get(db), "exact"
+    except Exception as e:
+        logger.error(f"Unhandled exception: {e.__class__.__name__}\nreturning 400")
+        logger.error(f"Database error occurred while counting messages: {str(e)}")
+        raise unhandled_exception
+
+
 async def get_message(db: AsyncSession, message_id: int):
     try:
-        result = await db.execute(select(Message).filter(Message.id == message_id).limit(1))
+        result = await db.execute(GET_MESSAGE_STMT, {"message_id": message_id})
         message = result.scalars().first()
         if message is None:
             logger.warning(f"Message with ID {message_id} not found")
@@ -79,7 +173,7 @@ async def update_message(db: AsyncSession, message_id: int, message: MessageUpda
 
 async def delete_message(db: AsyncSession, message_id: int):
     try:
-        result = await db.execute(select(Message).filter(Message.id == message_id))
+        result = await db.execute(GET_MESSAGE_STMT, {"message_id": message_id})
         db_message = result.scalars().first()
         if not db_message:
             logger.warning(f"Message with ID {message_id} not found for deletion")
@@ -87,6 +181,8 @@ async def delete_message(db: AsyncSession, message_id: int):
 
         await db.delete(db_message)
         await db.commit()
+        message_count.add(-1)
+        message_range_counts.add(db_message.created_at, -1)
         logger.info(f"Message with ID {message_id} deleted")
         return db_message
     except HTTPException:
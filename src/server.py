@@ -0,0 +1,269 @@
+"""
+Production entry point.
+
+Imports the application once in a supervisor process and forks the workers from it, so they start without importing
+anything and share the memory of the loaded modules. Workers serving `MAX_REQUESTS` requests shut down gracefully
+and are replaced with a fresh fork. With several workers, metrics are aggregated across them through
+`PROMETHEUS_MULTIPROC_DIR`.
+
+Run with:
+```
+python -m src.server
+```
+"""
+import asyncio
+import gc
+import glob
+import importlib.util
+import math
+import os
+import random
+import signal
+import socket
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import uvicorn
+
+from src.config import logger
+
+HOST = os.getenv("HOST", "127.0.0.1")
+PORT = int(os.getenv("PORT", "8000"))
+# Number of workers, `auto` sizes it from the CPUs available to the process.
+WEB_CONCURRENCY = os.getenv("WEB_CONCURRENCY", "1")
+KEEP_ALIVE_SECONDS = int(os.getenv("KEEP_ALIVE_SECONDS", "5"))
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+# Workers are recycled after this many requests plus a random jitter, `0` disables recycling.
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", "0"))
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+GRACEFUL_TIMEOUT_SECONDS = int(os.getenv("GRACEFUL_TIMEOUT_SECONDS", "30"))
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# Exit code of a worker whose application failed to start, the supervisor stops instead of forking it again.
+WORKER_STARTUP_FAILURE = 3
+
+
+def cpu_quota(cgroup_root: str = CGROUP_ROOT) -> Optional[float]:
+    """CPU quota of the cgroup of the process in CPUs, `None` when it is not limited."""
+    try:
+        with open(os.path.join(cgroup_root, "cpu.max")) as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    for controller in ("cpu", "cpu,cpuacct"):
+        try:
+            with open(os.path.join(cgroup_root, controller, "cpu.cfs_quota_us")) as f:
+                quota = int(f.read())
+            with open(os.path.join(cgroup_root, controller, "cpu.cfs_period_us")) as f:
+                period = int(f.read())
+        except (OSError, ValueError):
+            continue
+        return None if quota <= 0 or period <= 0 else quota / period
+    return None
+
+
+def available_cpus(cgroup_root: str = CGROUP_ROOT) -> int:
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = cpu_quota(cgroup_root)
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(cpus, 1)
+
+
+def worker_count(configured: str = WEB_CONCURRENCY, cgroup_root: str = CGROUP_ROOT) -> int:
+    if configured.strip().lower() == "auto":
+        return available_cpus(cgroup_root)
+    return max(int(configured), 1)
+
+
+def prepare_multiprocess_metrics(workers: int) -> Optional[str]:
+    """
+    Point prometheus_client at a directory shared by the workers, creating a temporary one when several workers run
+    and `PROMETHEUS_MULTIPROC_DIR` is not set, and clear the files left there by a previous run.
+
+    Has to run before prometheus_client is imported, which picks its storage on import.
+    """
+    if workers > 1 and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path is None:
+        return None
+    os.makedirs(path, exist_ok=True)
+    for stale in glob.glob(os.path.join(path, "*.db")):
+        os.remove(stale)
+    return path
+
+
+def check_workers(workers: int) -> bool:
+    """Refuse to run several workers when state that has to be shared would be kept per worker."""
+    if workers == 1:
+        return True
+    from src.messages.idempotency import IDEMPOTENCY_BACKEND
+    if IDEMPOTENCY_BACKEND == "memory":
+        logger.error(f"{workers} workers can't share idempotency keys kept in memory, "
+                     f"set IDEMPOTENCY_BACKEND=database or WEB_CONCURRENCY=1")
+        return False
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        logger.error(f"{workers} workers need PROMETHEUS_MULTIPROC_DIR set before the application is imported, "
+                     f"start them with `python -m src.server`")
+        return False
+    return True
+
+
+def event_loop() -> str:
+    return "uvloop" if importlib.util.find_spec("uvloop") is not None else "asyncio"
+
+
+def http_protocol() -> str:
+    return "httptools" if importlib.util.find_spec("httptools") is not None else "h11"
+
+
+def max_requests_limit(max_requests: int = MAX_REQUESTS, jitter: int = MAX_REQUESTS_JITTER) -> Optional[int]:
+    # The jitter keeps workers forked at the same time from being recycled at the same time.
+    if max_requests <= 0:
+        return None
+    return max_requests + random.randint(0, max(jitter, 0))
+
+
+class Supervisor:
+    """
+    Forks the workers from the preloaded application and replaces the ones that exit.
+
+    SIGTERM and SIGINT are forwarded to the workers, which finish their requests and exit. Workers still running after
+    `graceful_timeout` are killed.
+    """
+
+    def __init__(self, config: uvicorn.Config, workers: int, max_requests: int = MAX_REQUESTS,
+                 max_requests_jitter: int = MAX_REQUESTS_JITTER, graceful_timeout: int = GRACEFUL_TIMEOUT_SECONDS):
+        self.config = config
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.children: Dict[int, float] = {}
+        self.sockets: List[socket.socket] = []
+        self.should_exit = False
+        self.exit_code = 0
+
+    def run(self) -> int:
+        self.config.load()
+        self.sockets = [self.config.bind_socket()]
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self.handle_exit)
+        signal.signal(signal.SIGALRM, self.handle_timeout)
+        # Objects of the preloaded application are never collected, so the collector doesn't write to their
+        # pages and the workers keep sharing them.
+        gc.freeze()
+
+        logger.info(f"Starting {self.workers} workers with {self.config.loop} event loop and "
+                    f"{self.config.http} HTTP parser")
+        self.mark_process_dead(os.getpid())
+        for _ in range(self.workers):
+            self.spawn()
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            self.reap(pid, os.waitstatus_to_exitcode(status))
+
+        signal.alarm(0)
+        for sock in self.sockets:
+            sock.close()
+        return self.exit_code
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(self.run_worker())
+        self.children[pid] = time.monotonic()
+
+    def run_worker(self) -> int:
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGALRM):
+            signal.signal(sig, signal.SIG_DFL)
+        try:
+            self.config.limit_max_requests = max_requests_limit(self.max_requests, self.max_requests_jitter)
+            server = uvicorn.Server(self.config)
+            server.run(sockets=self.sockets)
+            return 0 if server.started else WORKER_STARTUP_FAILURE
+        except BaseException as e:
+            logger.error(f"Worker {os.getpid()} failed: {e.__class__.__name__}\nDetials: {e}")
+            return 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+    def reap(self, pid: int, code: int):
+        started_at = self.children.pop(pid, None)
+        self.mark_process_dead(pid)
+        if started_at is None or self.should_exit:
+            return
+        if code == WORKER_STARTUP_FAILURE:
+            logger.error(f"Worker {pid} failed to start, shutting down")
+            self.exit_code = code
+            self.shutdown()
+            return
+        if code == 0:
+            logger.info(f"Worker {pid} exited after {time.monotonic() - started_at:.0f}s, replacing it")
+        else:
+            logger.error(f"Worker {pid} exited with code {code}, replacing it")
+        self.spawn()
+
+    def shutdown(self):
+        self.should_exit = True
+        for pid in self.children:
+            self.signal_child(pid, signal.SIGTERM)
+        signal.alarm(self.graceful_timeout)
+
+    def handle_exit(self, sig, frame):
+        if not self.should_exit:
+            logger.info(f"Received {signal.Signals(sig).name}, stopping {len(self.children)} workers")
+            self.shutdown()
+
+    def handle_timeout(self, sig, frame):
+        logger.error(f"Killing {len(self.children)} workers, graceful shutdown timed out")
+        for pid in self.children:
+            self.signal_child(pid, signal.SIGKILL)
+
+    @staticmethod
+    def mark_process_dead(pid: int):
+        # Drops the live gauges of a process that no longer serves requests, the supervisor's own included.
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            # Imported here, prometheus_client must not be imported before `prepare_multiprocess_metrics` ran.
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(pid)
+
+    @staticmethod
+    def signal_child(pid: int, sig: int):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def serve(app, host: str = HOST, port: int = PORT, workers: Optional[int] = None) -> int:
+    workers = workers or worker_count()
+    if not check_workers(workers):
+        return 1
+    config = uvicorn.Config(app, host=host, port=port, loop=event_loop(), http=http_protocol(), lifespan="on",
+                            workers=workers, timeout_keep_alive=KEEP_ALIVE_SECONDS, backlog=BACKLOG,
+                            timeout_graceful_shutdown=GRACEFUL_TIMEOUT_SECONDS)
+    return Supervisor(config, workers).run()
+
+
+def main():
+    workers = worker_count()
+    prepare_multiprocess_metrics(workers)
+    from src.main import app, prepare_db
+    asyncio.run(prepare_db())
+    sys.exit(serve(app, workers=workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from prometheus_client import Counter
+
+from src.config import logger
+
+# Share of requests traced regardless of their outcome.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+# Requests slower than this, or failed ones, are always traced.
+TRACE_SLOW_THRESHOLD_SECONDS = float(os.getenv("TRACE_SLOW_THRESHOLD_SECONDS", "0.5"))
+# `none`, `logging` or `otlp`.
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "fastapi-app")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "2048"))
+
+TRACES_EXPORTED_COUNT = Counter('traces_exported_total', 'Total number of traces handed to the exporter')
+TRACES_DROPPED_COUNT = Counter('traces_dropped_total', 'Total number of traces dropped because the export queue was full')
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """Parse a W3C `traceparent` header into `(trace_id, parent_span_id, sampled)`."""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or parts[0] == "ff":
+        return None
+    try:
+        flags = int(parts[3][:2], 16)
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class Trace:
+    """Spans of one trace recorded in this process, exported together when the local root span ends."""
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        # Set when any span records an exception, even one the request recovered from.
+        self.error = False
+        self.spans: List["Span"] = []
+
+
+class Span:
+    def __init__(self, tracer: "Tracer", name: str, trace: Trace, parent_id: Optional[str],
+                 kind: str = "internal", attributes: Optional[dict] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.error = False
+        self.start_time = time.time()
+        self.end_time: Optional[float] = None
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    @property
+    def duration(self) -> float:
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.trace.sampled else '00'}"
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exc: BaseException):
+        self.error = True
+        self.trace.error = True
+        self.attributes["exception.type"] = exc.__class__.__name__
+        self.attributes["exception.message"] = str(exc)
+
+    def end(self):
+        if self.end_time is not None:
+            return
+        self.end_time = time.time()
+        self.trace.spans.append(self)
+        if self.is_local_root:
+            self.tracer.finish_trace(self)
+
+    @property
+    def is_local_root(self) -> bool:
+        return self.kind == "server" or self.parent_id is None
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class InMemorySpanExporter:
+    """Keeps exported spans in a list, meant for tests."""
+
+    def __init__(self):
+        self.spans: List[Span] = []
+
+    def export(self, spans: List[Span]):
+        self.spans.extend(spans)
+
+    def clear(self):
+        self.spans.clear()
+
+
+class LoggingSpanExporter:
+    def export(self, spans: List[Span]):
+        for span in spans:
+            logger.info(f"Span {json.dumps(span.to_dict(), default=str)}")
+
+
+class OTLPHttpSpanExporter:
+    """Sends spans to an OpenTelemetry collector using OTLP/HTTP with JSON encoding."""
+
+    def __init__(self, endpoint: str = TRACE_OTLP_ENDPOINT, service_name: str = TRACE_SERVICE_NAME,
+                 timeout: float = 5):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def export(self, spans: List[Span]):
+        body = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [self._attribute("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": "src.tracing"}, "spans": [self._span(span) for span in spans]}],
+        }]}).encode()
+        request = urllib.request.Request(self.endpoint, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+    def _span(self, span: Span) -> dict:
+        kinds = {"internal": 1, "server": 2, "client": 3}
+        return {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "parentSpanId": span.parent_id or "",
+            "name": span.name,
+            "kind": kinds.get(span.kind, 1),
+            "startTimeUnixNano": str(int(span.start_time * 1e9)),
+            "endTimeUnixNano": str(int(span.end_time * 1e9)),
+            "attributes": [self._attribute(key, value) for key, value in span.attributes.items()],
+            "status": {"code": 2 if span.error else 1},
+        }
+
+    @staticmethod
+    def _attribute(key: str, value) -> dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class SimpleSpanProcessor:
+    """Exports every trace synchronously, meant for tests."""
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    def on_end(self, spans: List[Span]):
+        self.exporter.export(spans)
+        TRACES_EXPORTED_COUNT.inc()
+
+
+class BatchSpanProcessor:
+    """
+    Hands finished traces to a background thread, so exporting never blocks the event loop.
+
+    When the queue is full the trace is dropped instead of waiting for the exporter.
+    """
+
+    def __init__(self, exporter, max_queue_size: int = TRACE_QUEUE_SIZE, max_batch_size: int = 512):
+        self.exporter = exporter
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self._start()
+        # Threads don't survive a fork, workers forked from a preloaded application start their own.
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue: "queue.Queue[List[Span]]" = queue.Queue(maxsize=self.max_queue_size)
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def on_end(self, spans: List[Span]):
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            TRACES_DROPPED_COUNT.inc()
+
+    def _run(self):
+        while True:
+            batch = list(self._queue.get())
+            traces = 1
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.extend(self._queue.get_nowait())
+                    traces += 1
+                except queue.Empty:
+                    break
+            try:
+                self.exporter.export(batch)
+                TRACES_EXPORTED_COUNT.inc(traces)
+            except Exception as e:
+                logger.error(f"Span export failed: {e.__class__.__name__}\nDetials: {e}")
+
+
+class Tracer:
+    def __init__(self, processor=None, sample_rate: float = TRACE_SAMPLE_RATE,
+                 slow_threshold: float = TRACE_SLOW_THRESHOLD_SECONDS):
+        self.processor = processor
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+
+    def start_span(self, name: str, kind: str = "internal", attributes: Optional[dict] = None,
+                   traceparent: Optional[str] = None) -> Span:
+        """
+        Start a span without making it current.
+
+        The parent is the current span, or the remote parent from `traceparent` for a server span. Spans without
+        a parent start a new trace with a head-based sampling decision.
+        """
+        remote = parse_traceparent(traceparent)
+        parent = _current_span.get()
+        if remote is not None:
+            trace_id, parent_id, sampled = remote
+            trace = Trace(trace_id, sampled or random.random() < self.sample_rate)
+        elif parent is not None:
+            trace, parent_id = parent.trace, parent.span_id
+        else:
+            trace = Trace(f"{random.getrandbits(128):032x}", random.random() < self.sample_rate)
+            parent_id = None
+        return Span(self, name, trace, parent_id, kind=kind, attributes=attributes)
+
+    @contextmanager
+    def span(self, name: str, kind: str = "internal", attributes: Optional[dict] = None,
+             traceparent: Optional[str] = None):
+        span = self.start_span(name, kind=kind, attributes=attributes, traceparent=traceparent)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def should_export(self, trace: Trace, duration: float, error: bool) -> bool:
+        """Head-sampled traces are kept, unsampled ones only when they were slow or any of their spans failed."""
+        return trace.sampled or trace.error or error or duration >= self.slow_threshold
+
+    def finish_trace(self, root: Span):
+        if self.processor is None or not self.should_export(root.trace, root.duration, root.error):
+            return
+        self.processor.on_end(root.trace.spans)
+
+    def exemplar(self, duration: float, error: bool = False) -> Optional[Dict[str, str]]:
+        """
+        Exemplar linking a metric observation to the current trace.
+
+        Returned only when the trace will be exported: a slow observation means its request is at least as slow, and
+        a failed one marks the trace as failed.
+        """
+        span = _current_span.get()
+        if span is None or self.processor is None or not self.should_export(span.trace, duration, error):
+            return None
+        if error:
+            span.trace.error = True
+        return {"trace_id": span.trace_id}
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def create_processor(exporter_name: str = TRACE_EXPORTER):
+    exporters = {"logging": LoggingSpanExporter, "otlp": OTLPHttpSpanExporter}
+    if exporter_name not in exporters:
+        return None
+    return BatchSpanProcessor(exporters[exporter_name]())
+
+
+tracer = Tracer(processor=create_processor())
+
+
+class TracingMiddleware:
+    """Starts a server span for every HTTP request and continues the W3C trace context of the caller."""
+
+    def __init__(self, app, tracer: Tracer = tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers", []))
+        traceparent = headers.get(b"traceparent", b"").decode() or None
+        attributes = {"http.method": scope["method"], "http.target": scope["path"]}
+
+        with self.tracer.span(f"{scope['method']} {scope['path']}", kind="server", attributes=attributes,
+                              traceparent=traceparent) as span:
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code", message["status"])
+                    span.error = span.error or message["status"] >= 500
+                    message = {**message, "headers": [*message.get("headers", []),
+                                                      (b"traceparent", span.traceparent.encode())]}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_trace)
+            finally:
+                route = scope.get("route")
+                if route is not None:
+                    span.name = f"{scope['method']} {route.path}"
+                    span.set_attribute("http.route", route.path)
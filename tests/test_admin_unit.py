@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import pytest
+
+from src.admin.profiler import ProfilerState, SamplingProfiler
+from src.auth.service import is_admin_token, sign_jwt
+
+
+def busy_wait(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+async def slow_handler():
+    busy_wait(0.05)
+    await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+async def test_worker_profile_samples_loop_thread():
+    profiler = SamplingProfiler("worker", interval=0.001).start()
+    busy_wait(0.05)
+    profile = profiler.stop()
+
+    collapsed = profile.to_collapsed()
+    assert "busy_wait" in collapsed
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed.strip().splitlines())
+
+
+@pytest.mark.asyncio
+async def test_request_profile_follows_awaits():
+    task = asyncio.create_task(slow_handler())
+    profiler = SamplingProfiler("request", task=task, interval=0.001).start()
+    await task
+    profile = profiler.stop()
+
+    stacks = [[name for name, _, _ in stack] for stack in profile.samples]
+    assert any(stack[:2] == ["slow_handler", "busy_wait"] for stack in stacks)
+    assert any(stack[:2] == ["slow_handler", "sleep"] for stack in stacks)
+
+
+@pytest.mark.asyncio
+async def test_speedscope_output():
+    profiler = SamplingProfiler("worker", interval=0.001).start()
+    busy_wait(0.02)
+    speedscope = profiler.stop().to_speedscope()
+
+    frames = speedscope["shared"]["frames"]
+    sampled = speedscope["profiles"][0]
+    assert sampled["type"] == "sampled"
+    assert len(sampled["samples"]) == len(sampled["weights"])
+    assert all(index < len(frames) for stack in sampled["samples"] for index in stack)
+
+
+@pytest.mark.asyncio
+async def test_profiler_state_allows_one_profile():
+    state = ProfilerState()
+
+    assert state.start("first") is not None
+    assert state.start("second") is None
+    assert not state.can_profile_request()
+    profile = state.stop()
+
+    assert state.profiles[profile.id] is profile
+    assert state.start("request", task=asyncio.current_task()) is not None
+    state.stop()
+    assert not state.can_profile_request()
+
+
+def test_is_admin_token(monkeypatch):
+    monkeypatch.setattr("src.auth.service.ADMIN_EMAILS", {"admin@example.com"})
+
+    assert is_admin_token(sign_jwt("admin@example.com")["access_token"])
+    assert not is_admin_token(sign_jwt("user@example.com")["access_token"])
+    assert not is_admin_token("invalid_token")
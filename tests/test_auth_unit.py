@@ -2,12 +2,17 @@ import pytest
 import time
 from unittest.mock import AsyncMock, MagicMock
 from passlib.context import CryptContext
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.future import select
+from sqlalchemy.orm import sessionmaker
+from src.auth.denylist import TokenDenylist
 from src.auth.service import (
-    get_password_hash,
-    create_user, authenticate_user, refresh_user_token
+    get_password_hash, decode_jwt, sign_jwt, JWTBearer,
+    create_user, authenticate_user, refresh_user_token, issue_tokens, revoke_user_tokens,
+    sync_denylist, purge_expired_tokens
 )
-from src.auth.models import User
+from src.database import Base
+from src.auth.models import User, RefreshToken, RevokedToken
 from src.auth.schemas import CreateUserReq
 
 SECRET_KEY = "test-secret-key"
@@ -16,6 +21,14 @@ ALGORITHM = "HS256"
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
+@pytest.fixture(autouse=True)
+def denylist(monkeypatch):
+    """A fresh denylist per test, so revocations don't leak into other tests."""
+    tokens = TokenDenylist()
+    monkeypatch.setattr("src.auth.service.denylist", tokens)
+    return tokens
+
+
 @pytest.mark.asyncio
 async def test_create_user():
     db_mock = AsyncMock(AsyncSession)
@@ -76,3 +89,125 @@ async def test_refresh_user_token_invalid():
         await refresh_user_token(token, db_mock)
 
     assert not db_mock.commit.called
+
+
+@pytest.mark.asyncio
+async def test_issue_tokens_stores_refresh_token():
+    db_mock = AsyncMock(AsyncSession)
+    db_mock.add = MagicMock()
+
+    tokens = await issue_tokens("test@example.com", db_mock)
+
+    stored = db_mock.add.call_args.args[0]
+    assert isinstance(stored, RefreshToken)
+    assert decode_jwt(tokens["refresh_token"])["jti"] == stored.jti
+    assert decode_jwt(tokens["access_token"])["type"] == "access"
+    assert db_mock.commit.called
+
+
+@pytest.mark.asyncio
+async def test_refresh_user_token_rotates():
+    db_mock = AsyncMock(AsyncSession)
+    db_mock.add = MagicMock()
+    db_mock.execute.return_value = MagicMock(rowcount=1)
+    refresh_token = (await issue_tokens("test@example.com", db_mock))["refresh_token"]
+
+    new_tokens = await refresh_user_token(refresh_token, db_mock)
+
+    assert new_tokens["refresh_token"] != refresh_token
+    assert decode_jwt(new_tokens["access_token"])["sub"] == "test@example.com"
+
+
+@pytest.mark.asyncio
+async def test_refresh_user_token_reuse_revokes_all():
+    db_mock = AsyncMock(AsyncSession)
+    db_mock.add = MagicMock()
+    db_mock.execute.return_value = MagicMock(rowcount=0)
+    refresh_token = (await issue_tokens("test@example.com", db_mock))["refresh_token"]
+
+    with pytest.raises(Exception):
+        await refresh_user_token(refresh_token, db_mock)
+
+    assert db_mock.execute.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_refresh_user_token_rejects_access_token():
+    db_mock = AsyncMock(AsyncSession)
+
+    with pytest.raises(Exception):
+        await refresh_user_token(sign_jwt("test@example.com")["access_token"], db_mock)
+
+    assert not db_mock.execute.called
+
+
+@pytest.mark.asyncio
+async def test_revoked_access_token_is_rejected(denylist):
+    db_mock = AsyncMock(AsyncSession)
+    db_mock.add = MagicMock()
+    access_token = sign_jwt("test@example.com")["access_token"]
+    assert JWTBearer().verify_jwt(access_token)
+
+    await revoke_user_tokens(access_token, db_mock)
+
+    assert isinstance(db_mock.add.call_args.args[0], RevokedToken)
+    assert not JWTBearer().verify_jwt(access_token)
+    assert decode_jwt(access_token)["jti"] in denylist
+
+
+def test_denylist_expires_entries():
+    tokens = TokenDenylist()
+    tokens.add("expired", time.time() - 1)
+    tokens.add("soon", time.time() + 0.5)
+    tokens.add("later", time.time() + 60)
+
+    assert "expired" not in tokens
+    assert "soon" in tokens
+    assert tokens.purge_expired(time.time() + 1) == 1
+    assert "soon" not in tokens
+    assert len(tokens) == 1
+
+
+async def token_session():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    return engine, sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+
+@pytest.mark.asyncio
+async def test_sync_denylist_picks_up_revocations_committed_late(denylist):
+    engine, session_factory = await token_session()
+    async with session_factory() as db:
+        since = await sync_denylist(db)
+        # Stamped before the previous sync ran, committed after it.
+        db.add(RevokedToken(jti="late", expires_at=int(time.time()) + 60, revoked_at=since - 1))
+        await db.commit()
+
+        await sync_denylist(db, since)
+
+    await engine.dispose()
+    assert "late" in denylist
+
+
+@pytest.mark.asyncio
+async def test_purge_expired_tokens():
+    engine, session_factory = await token_session()
+    now = int(time.time())
+    async with session_factory() as db:
+        db.add_all([
+            RefreshToken(jti="expired", email="test@example.com", expires_at=now - 1, revoked=True),
+            RefreshToken(jti="valid", email="test@example.com", expires_at=now + 60, revoked=False),
+            RevokedToken(jti="expired", expires_at=now - 1, revoked_at=now - 600),
+            RevokedToken(jti="valid", expires_at=now + 60, revoked_at=now),
+        ])
+        await db.commit()
+
+        purged = await purge_expired_tokens(db)
+        refresh_tokens = (await db.execute(select(RefreshToken.jti))).scalars().all()
+        revoked_tokens = (await db.execute(select(RevokedToken.jti))).scalars().all()
+
+    await engine.dispose()
+    assert purged == 2
+    assert refresh_tokens == ["valid"]
+    assert revoked_tokens == ["valid"]
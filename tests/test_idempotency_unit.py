@@ -0,0 +1,197 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from starlette.requests import Request
+
+from src.auth.service import sign_jwt
+from src.database import Base
+from src.messages.idempotency import (DatabaseIdempotencyStore, IdempotencyStore, MemoryIdempotencyStore,
+                                      StoredResponse, run_idempotent)
+from src.messages.models import Message
+from src.messages.schemas import MessageResponse
+
+
+def make_request(body: bytes = b'{"text": "Hello"}', email: str = "test@example.com") -> Request:
+    token = sign_jwt(email)["access_token"]
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/messages/",
+        "headers": [(b"authorization", f"Bearer {token}".encode())],
+        "query_string": b"",
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return Request(scope, receive)
+
+
+def make_handler(calls):
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return Message(id=len(calls), text="Hello", created_at=datetime.now(timezone.utc))
+
+    return handler
+
+
+@pytest.mark.asyncio
+async def test_repeated_key_is_replayed():
+    store, calls = MemoryIdempotencyStore(), []
+
+    first = await run_idempotent(make_request(), "key-1", make_handler(calls), MessageResponse, store=store)
+    second = await run_idempotent(make_request(), "key-1", make_handler(calls), MessageResponse, store=store)
+
+    assert calls == [1]
+    assert second.body == first.body
+    assert second.headers["Idempotent-Replayed"] == "true"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicate_waits_for_first_request():
+    store, calls = MemoryIdempotencyStore(), []
+
+    responses = await asyncio.gather(*(
+        run_idempotent(make_request(), "key-1", make_handler(calls), MessageResponse, store=store)
+        for _ in range(3)
+    ))
+
+    assert calls == [1]
+    assert len({response.body for response in responses}) == 1
+
+
+@pytest.mark.asyncio
+async def test_keys_are_scoped_per_user_and_checked_against_body():
+    store, calls = MemoryIdempotencyStore(), []
+
+    await run_idempotent(make_request(), "key-1", make_handler(calls), MessageResponse, store=store)
+    await run_idempotent(make_request(email="other@example.com"), "key-1", make_handler(calls), MessageResponse,
+                         store=store)
+    with pytest.raises(HTTPException) as exc_info:
+        await run_idempotent(make_request(b'{"text": "Other"}'), "key-1", make_handler(calls), MessageResponse,
+                             store=store)
+
+    assert calls == [1, 1]
+    assert exc_info.value.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_failed_request_releases_key():
+    store = MemoryIdempotencyStore()
+
+    async def failing_handler():
+        raise HTTPException(status_code=400)
+
+    with pytest.raises(HTTPException):
+        await run_idempotent(make_request(), "key-1", failing_handler, MessageResponse, store=store)
+    response = await run_idempotent(make_request(), "key-1", make_handler([]), MessageResponse, store=store)
+
+    assert json.loads(response.body)["id"] == 1
+
+
+@pytest.mark.asyncio
+async def test_memory_store_is_bounded_and_expires():
+    store = MemoryIdempotencyStore(max_keys=2)
+    for key in ("a", "b", "c"):
+        await store.save(key, StoredResponse("fingerprint", 200, "{}"))
+
+    assert len(store) == 2
+    assert await store.load("a") is None
+
+    expiring = MemoryIdempotencyStore(ttl=0)
+    await expiring.save("a", StoredResponse("fingerprint", 200, "{}"))
+    assert await expiring.load("a") is None
+
+
+@pytest.mark.asyncio
+async def test_memory_store_never_evicts_requests_in_flight():
+    store = MemoryIdempotencyStore(max_keys=2)
+    assert await store.begin("a", "fingerprint") is None
+    for key in ("b", "c"):
+        await store.save(key, StoredResponse("fingerprint", 200, "{}"))
+
+    assert not await store.claim("a", "fingerprint")
+    assert await store.load("b") is None
+    assert len(store) == 2
+
+    for key in ("d", "e"):
+        assert await store.begin(key, "fingerprint") is None
+    assert len(store) == 3
+    assert all([not await store.claim(key, "fingerprint") for key in ("a", "d", "e")])
+
+
+def test_store_backends_must_implement_storage():
+    with pytest.raises(TypeError):
+        IdempotencyStore()
+
+
+@pytest.mark.asyncio
+async def test_database_store_saves_response_when_claim_was_purged():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    store = DatabaseIdempotencyStore(session_factory=sessionmaker(bind=engine, class_=AsyncSession,
+                                                                  expire_on_commit=False))
+
+    assert await store.claim("key-1", "fingerprint")
+    await store.release("key-1")
+    await store.save("key-1", StoredResponse("fingerprint", 200, '{"id": 1}'))
+    stored = await store.load("key-1")
+
+    await engine.dispose()
+    assert stored.completed and stored.body == '{"id": 1}'
+
+
+@pytest.mark.asyncio
+async def test_database_store_shares_keys():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    worker_1 = DatabaseIdempotencyStore(session_factory=session_factory)
+    worker_2 = DatabaseIdempotencyStore(session_factory=session_factory, wait=1)
+
+    assert await worker_1.begin("key-1", "fingerprint") is None
+    waiting = asyncio.create_task(worker_2.begin("key-1", "fingerprint"))
+    await asyncio.sleep(0.1)
+    assert not waiting.done()
+    await worker_1.complete("key-1", StoredResponse("fingerprint", 200, '{"id": 1}'))
+    replayed = await waiting
+
+    await engine.dispose()
+    assert replayed.body == '{"id": 1}'
+
+
+@pytest.mark.asyncio
+async def test_database_store_keeps_claim_of_request_outliving_lease(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/keys.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    worker_1 = DatabaseIdempotencyStore(session_factory=session_factory, lease=2, wait=0.5)
+    worker_2 = DatabaseIdempotencyStore(session_factory=session_factory, lease=2, wait=1)
+    calls = []
+
+    async def slow_handler():
+        calls.append(1)
+        await asyncio.sleep(2.5)
+        return Message(id=1, text="Hello", created_at=datetime.now(timezone.utc))
+
+    first = asyncio.create_task(run_idempotent(make_request(), "key-1", slow_handler, MessageResponse,
+                                               store=worker_1))
+    await asyncio.sleep(2.2)
+    # Past both the wait and the lease of the claim, a retry purging it would run the handler again.
+    retry = await run_idempotent(make_request(), "key-1", slow_handler, MessageResponse, store=worker_2)
+    first = await first
+
+    await engine.dispose()
+    assert calls == [1]
+    assert retry.body == first.body
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert not worker_1._renewal_tasks
@@ -0,0 +1,66 @@
+import asyncio
+import gc
+import time
+
+import pytest
+
+from src.loop_monitor import LoopMonitor, GC_PAUSE, route_label
+
+
+def block_loop(seconds):
+    time.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_blocking_callback_is_reported_with_stack_and_route():
+    monitor = LoopMonitor(interval=0.01, threshold=0.05)
+    monitor.start()
+    try:
+        async def handler():
+            monitor.track_request({"method": "GET", "path": "/slow"})
+            await asyncio.sleep(0.05)
+            block_loop(0.3)
+            await asyncio.sleep(0.05)
+
+        await handler()
+    finally:
+        monitor.stop()
+
+    assert len(monitor.blocks) == 1
+    block = monitor.blocks[0]
+    assert block["duration"] >= 0.2
+    assert block["route"] == "GET unmatched"
+    assert "block_loop" in block["stack"]
+
+
+@pytest.mark.asyncio
+async def test_idle_loop_reports_no_blocks():
+    monitor = LoopMonitor(interval=0.01, threshold=0.1)
+    monitor.start()
+    await asyncio.sleep(0.1)
+    monitor.stop()
+
+    assert len(monitor.blocks) == 0
+
+
+def gc_pauses(generation):
+    return sum(bucket.get() for bucket in GC_PAUSE.labels(generation=generation)._buckets)
+
+
+@pytest.mark.asyncio
+async def test_gc_pauses_are_observed():
+    monitor = LoopMonitor()
+    monitor.start()
+    before = gc_pauses(2)
+    gc.collect()
+    monitor.stop()
+
+    assert gc_pauses(2) == before + 1
+
+
+def test_route_label_uses_route_template():
+    class Route:
+        path = "/messages/{message_id}"
+
+    assert route_label({"method": "GET", "path": "/messages/1", "route": Route()}) == "GET /messages/{message_id}"
+    assert route_label({"method": "GET", "path": "/nowhere"}) == "GET unmatched"
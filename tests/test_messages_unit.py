@@ -1,9 +1,23 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
 import pytest
 from unittest.mock import AsyncMock, MagicMock
-from sqlalchemy.ext.asyncio import AsyncSession
-from src.messages.models import Message
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from src.database import Base
+from src.messages.models import Message, utcnow
+from src.messages.partitions import partition_bounds, expired_partitions, is_partitioned, maintain_partitions, \
+    migrate_messages_table, create_partitioned_table
 from src.messages.schemas import MessageReq, MessageUpdate
-from src.messages.service import create_message, get_messages, get_message, update_message, delete_message
+from src.messages.counts import message_count, message_range_counts, CachedRangeCounts, \
+    COUNT_MESSAGES_BETWEEN_STMT
+from src.messages.loader import BatchLoader
+from src.tracing import InMemorySpanExporter, SimpleSpanProcessor, Tracer, current_span
+from src.messages.service import create_message, get_messages, get_message, update_message, delete_message, \
+    count_messages, get_messages_by_ids, GET_MESSAGE_STMT
 
 
 @pytest.mark.asyncio
@@ -130,3 +144,266 @@ async def test_delete_message_not_found():
 
     assert deleted_message is None
     assert not db_mock.commit.called
+
+
+@pytest.mark.asyncio
+async def test_count_messages_exact_is_cached():
+    message_count.invalidate()
+    db_mock = AsyncMock(AsyncSession)
+    db_mock.bind = MagicMock()
+    db_mock.bind.dialect.name = "sqlite"
+
+    result_mock = MagicMock()
+    result_mock.scalar.return_value = 41
+    db_mock.execute.return_value = result_mock
+
+    assert await count_messages(db_mock, "approximate") == (41, "exact")
+    await create_message(db_mock, MessageReq(text="Hello, World!"))
+    assert await count_messages(db_mock, "exact") == (42, "exact")
+    assert db_mock.execute.call_count == 1
+    message_count.invalidate()
+
+
+@pytest.mark.asyncio
+async def test_count_messages_approximate_on_postgresql():
+    message_count.invalidate()
+    db_mock = AsyncMock(AsyncSession)
+    db_mock.bind = MagicMock()
+    db_mock.bind.dialect.name = "postgresql"
+
+    result_mock = MagicMock()
+    result_mock.scalar.return_value = 1000000
+    db_mock.execute.return_value = result_mock
+
+    assert await count_messages(db_mock, "approximate") == (1000000, "approximate")
+
+    estimate_mock, count_mock = MagicMock(), MagicMock()
+    estimate_mock.scalar.return_value = -1
+    count_mock.scalar.return_value = 7
+    db_mock.execute.side_effect = [estimate_mock, count_mock]
+
+    assert await count_messages(db_mock, "approximate") == (7, "exact")
+    message_count.invalidate()
+
+
+@pytest.mark.asyncio
+async def test_count_messages_in_range_is_cached():
+    message_range_counts.invalidate()
+    db_mock = AsyncMock(AsyncSession)
+    db_mock.bind = MagicMock()
+    db_mock.bind.dialect.name = "postgresql"
+
+    result_mock = MagicMock()
+    result_mock.scalar.return_value = 5
+    db_mock.execute.return_value = result_mock
+    since, until = datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 2, 1, tzinfo=timezone.utc)
+
+    assert await count_messages(db_mock, "approximate", since=since, until=until) == (5, "exact")
+    message_range_counts.add(datetime(2024, 1, 15), 1)
+    message_range_counts.add(datetime(2024, 2, 1, tzinfo=timezone.utc), 1)
+    assert await count_messages(db_mock, "exact", since=since, until=until) == (6, "exact")
+    assert db_mock.execute.call_count == 1
+
+    assert await count_messages(db_mock, "exact", since=since) == (5, "exact")
+    assert db_mock.execute.call_count == 2
+    message_range_counts.invalidate()
+
+
+@pytest.mark.asyncio
+async def test_range_counts_are_bounded():
+    counts = CachedRangeCounts(COUNT_MESSAGES_BETWEEN_STMT, max_ranges=2)
+    db_mock = AsyncMock(AsyncSession)
+    db_mock.execute.return_value = MagicMock()
+
+    for day in range(1, 4):
+        await counts.get(db_mock, datetime(2024, 1, day, tzinfo=timezone.utc), datetime(2024, 2, 1, tzinfo=timezone.utc))
+
+    assert len(counts) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_messages_by_ids_keeps_requested_order():
+    db_mock = AsyncMock(AsyncSession)
+    db_mock.bind = MagicMock()
+    db_mock.bind.dialect.name = "postgresql"
+
+    result_mock = MagicMock()
+    result_mock.scalars.return_value.all.return_value = [Message(id=1, text="Message 1"), Message(id=3, text="Message 3")]
+    db_mock.execute.return_value = result_mock
+
+    messages = await get_messages_by_ids(db_mock, [3, 2, 1])
+
+    assert [message.id for message in messages] == [3, 1]
+    assert db_mock.execute.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_loader_merges_concurrent_lookups():
+    calls = []
+
+    async def batch_fn(keys):
+        calls.append(sorted(keys))
+        return {key: f"message {key}" for key in keys if key != 404}
+
+    loader = BatchLoader("test", batch_fn, window=0.01, max_batch_size=10)
+    results = await asyncio.gather(*(loader.load(key) for key in [1, 2, 2, 404]))
+
+    assert results == ["message 1", "message 2", "message 2", None]
+    assert calls == [[1, 2, 404]]
+    assert not loader._tasks
+
+
+@pytest.mark.asyncio
+async def test_batch_loader_dispatches_full_batches():
+    calls = []
+
+    async def batch_fn(keys):
+        calls.append(len(keys))
+        return {key: key for key in keys}
+
+    loader = BatchLoader("test", batch_fn, window=10, max_batch_size=2)
+    results = await asyncio.wait_for(asyncio.gather(*(loader.load(key) for key in range(4))), timeout=1)
+
+    assert results == [0, 1, 2, 3]
+    assert calls == [2, 2]
+
+
+@pytest.mark.asyncio
+async def test_batch_loader_propagates_errors():
+    async def batch_fn(keys):
+        raise RuntimeError("database is down")
+
+    loader = BatchLoader("test", batch_fn, window=0.001)
+
+    with pytest.raises(RuntimeError):
+        await loader.load(1)
+
+
+@pytest.mark.asyncio
+async def test_batch_loader_keeps_traces_of_merged_requests_apart(monkeypatch):
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(processor=SimpleSpanProcessor(exporter), sample_rate=1)
+    monkeypatch.setattr("src.messages.loader.tracer", tracer)
+    spans_in_batch = []
+
+    async def batch_fn(keys):
+        spans_in_batch.append(current_span())
+        return {key: key for key in keys}
+
+    loader = BatchLoader("test", batch_fn, window=0.01)
+
+    async def request(key):
+        with tracer.span("request", kind="server") as root:
+            await loader.load(key)
+        return root
+
+    roots = await asyncio.gather(request(1), request(2))
+
+    assert spans_in_batch == [None]
+    for root in roots:
+        assert [span.name for span in root.trace.spans] == ["loader.wait", "request"]
+        assert root.trace.spans[0].parent_id == root.span_id
+
+
+def test_partition_bounds_cross_year():
+    partitions = partition_bounds(datetime(2024, 11, 15, tzinfo=timezone.utc), ahead=2)
+
+    assert [name for name, _, _ in partitions] == ["messages_p202411", "messages_p202412", "messages_p202501"]
+    assert partitions[1][1] == datetime(2024, 12, 1, tzinfo=timezone.utc)
+    assert partitions[1][2] == datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def test_expired_partitions():
+    names = ["messages_p202401", "messages_p202402", "messages_p202403", "messages_default"]
+    now = datetime(2024, 5, 10, tzinfo=timezone.utc)
+
+    assert expired_partitions(names, now, retention_months=2) == ["messages_p202401", "messages_p202402"]
+    assert expired_partitions(names, now, retention_months=0) == []
+
+
+TEST_POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+
+async def explain(conn, stmt) -> str:
+    sql = stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+    return "\n".join(row[0] for row in (await conn.execute(text(f"EXPLAIN {sql}"))).all())
+
+
+@pytest.mark.skipif(TEST_POSTGRES_URL is None, reason="TEST_POSTGRES_URL is not set")
+@pytest.mark.asyncio
+async def test_id_lookups_probe_every_partition_and_ranges_are_pruned():
+    engine = create_async_engine(TEST_POSTGRES_URL)
+    # Runs in a transaction that is rolled back, leaving the database as it was.
+    async with engine.connect() as conn:
+        await conn.execute(text("DROP TABLE IF EXISTS messages CASCADE"))
+        await create_partitioned_table(conn)
+        await conn.execute(text("SET LOCAL enable_seqscan = off"))
+        partitions = partition_bounds(utcnow())
+        _, since, until = partitions[0]
+
+        by_id = await explain(conn, GET_MESSAGE_STMT.params(message_id=1))
+        by_range = await explain(conn, COUNT_MESSAGES_BETWEEN_STMT.params(since=since, until=until))
+        await conn.rollback()
+    await engine.dispose()
+
+    assert all(name in by_id for name, _, _ in partitions) and "messages_default" in by_id
+    assert "Seq Scan" not in by_id
+    assert partitions[0][0] in by_range
+    assert not any(name in by_range for name, _, _ in partitions[1:])
+
+
+@pytest.mark.asyncio
+async def test_sqlite_fallback_is_not_partitioned():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        assert not await is_partitioned(conn)
+    await maintain_partitions(engine)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    now = datetime.now(timezone.utc)
+    async with session_factory() as db:
+        db.add_all([Message(text="old", created_at=now - timedelta(days=40)),
+                    Message(text="new", created_at=now - timedelta(days=1))])
+        await db.commit()
+
+        recent = await get_messages(db, since=now - timedelta(days=7))
+        older = await get_messages(db, until=now - timedelta(days=7))
+        total = await count_messages(db, "approximate", since=now - timedelta(days=7))
+        created = await create_message(db, MessageReq(text="defaulted"))
+
+    await engine.dispose()
+    assert [message.text for message in recent] == ["new"]
+    assert [message.text for message in older] == ["old"]
+    assert total == (1, "exact")
+    assert created.created_at is not None
+
+
+@pytest.mark.asyncio
+async def test_existing_table_without_created_at_is_migrated(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/messages.db")
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE messages (id INTEGER NOT NULL PRIMARY KEY, text VARCHAR NOT NULL)"))
+        await conn.execute(text("INSERT INTO messages (text) VALUES ('before')"))
+
+    migrated = []
+    for _ in range(2):
+        async with engine.begin() as conn:
+            migrated.append(await migrate_messages_table(conn))
+            await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    now = datetime.now(timezone.utc)
+    async with session_factory() as db:
+        existing = await get_message(db, 1)
+        created = await create_message(db, MessageReq(text="after"))
+        recent = await get_messages(db, since=now - timedelta(days=1))
+    async with engine.connect() as conn:
+        indexes = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_indexes("messages"))
+
+    await engine.dispose()
+    assert migrated == [True, False]
+    assert existing.created_at is not None
+    assert created.created_at is not None
+    assert [message.text for message in recent] == ["before", "after"]
+    assert "ix_messages_created_at" in [index["name"] for index in indexes]
@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+from src import server
+from src.server import cpu_quota, available_cpus, worker_count, max_requests_limit, prepare_multiprocess_metrics, \
+    check_workers
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_cpu_quota_reads_cgroup_v2(tmp_path):
+    write(tmp_path / "cpu.max", "150000 100000\n")
+
+    assert cpu_quota(str(tmp_path)) == 1.5
+
+
+def test_cpu_quota_unlimited_cgroup_v2(tmp_path):
+    write(tmp_path / "cpu.max", "max 100000\n")
+
+    assert cpu_quota(str(tmp_path)) is None
+
+
+@pytest.mark.parametrize("controller", ["cpu", "cpu,cpuacct"])
+def test_cpu_quota_reads_cgroup_v1(tmp_path, controller):
+    write(tmp_path / controller / "cpu.cfs_quota_us", "200000\n")
+    write(tmp_path / controller / "cpu.cfs_period_us", "100000\n")
+
+    assert cpu_quota(str(tmp_path)) == 2
+
+
+def test_cpu_quota_unlimited_cgroup_v1(tmp_path):
+    write(tmp_path / "cpu" / "cpu.cfs_quota_us", "-1\n")
+    write(tmp_path / "cpu" / "cpu.cfs_period_us", "100000\n")
+
+    assert cpu_quota(str(tmp_path)) is None
+
+
+def test_cpu_quota_without_cgroup(tmp_path):
+    assert cpu_quota(str(tmp_path)) is None
+
+
+def test_available_cpus_rounds_quota_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+    write(tmp_path / "cpu.max", "150000 100000\n")
+
+    assert available_cpus(str(tmp_path)) == 2
+
+
+def test_available_cpus_limited_by_affinity(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: {0, 1}, raising=False)
+    write(tmp_path / "cpu.max", "400000 100000\n")
+
+    assert available_cpus(str(tmp_path)) == 2
+
+
+def test_available_cpus_with_small_quota(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+    write(tmp_path / "cpu.max", "10000 100000\n")
+
+    assert available_cpus(str(tmp_path)) == 1
+
+
+def test_worker_count(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+    write(tmp_path / "cpu.max", "200000 100000\n")
+
+    assert worker_count("3", str(tmp_path)) == 3
+    assert worker_count("1", str(tmp_path)) == 1
+    assert worker_count("auto", str(tmp_path)) == 2
+
+
+def test_prepare_multiprocess_metrics(tmp_path, monkeypatch):
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+    assert prepare_multiprocess_metrics(1) is None
+
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    write(tmp_path / "counter_123.db", "stale")
+
+    assert prepare_multiprocess_metrics(2) == str(tmp_path)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_several_workers_need_shared_state(monkeypatch):
+    monkeypatch.setattr("src.messages.idempotency.IDEMPOTENCY_BACKEND", "memory")
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", "/tmp")
+    assert check_workers(1)
+    assert not check_workers(2)
+
+    monkeypatch.setattr("src.messages.idempotency.IDEMPOTENCY_BACKEND", "database")
+    assert check_workers(2)
+
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR")
+    assert not check_workers(2)
+
+
+def test_event_loop_and_http_fall_back_without_optional_packages(monkeypatch):
+    monkeypatch.setattr(server.importlib.util, "find_spec", lambda name: None)
+
+    assert server.event_loop() == "asyncio"
+    assert server.http_protocol() == "h11"
+
+
+def test_event_loop_and_http_use_optional_packages(monkeypatch):
+    monkeypatch.setattr(server.importlib.util, "find_spec", lambda name: object())
+
+    assert server.event_loop() == "uvloop"
+    assert server.http_protocol() == "httptools"
+
+
+def test_max_requests_limit():
+    assert max_requests_limit(0, 100) is None
+    assert max_requests_limit(1000, 0) == 1000
+    assert all(1000 <= max_requests_limit(1000, 50) <= 1050 for _ in range(100))
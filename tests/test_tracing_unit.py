@@ -0,0 +1,146 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from src.database import Base, TracedAsyncAdaptedQueuePool, instrument_engine
+from src.messages.models import Message
+from src.messages.service import get_message
+from src.tracing import InMemorySpanExporter, SimpleSpanProcessor, Tracer, TracingMiddleware, parse_traceparent
+
+TRACEPARENT = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+
+def make_tracer(**kwargs):
+    exporter = InMemorySpanExporter()
+    return Tracer(processor=SimpleSpanProcessor(exporter), **kwargs), exporter
+
+
+def test_parse_traceparent():
+    assert parse_traceparent(TRACEPARENT) == ("4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7", True)
+    assert parse_traceparent("00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-00")[2] is False
+    assert parse_traceparent("00-" + "0" * 32 + "-00f067aa0ba902b7-01") is None
+    assert parse_traceparent("garbage") is None
+    assert parse_traceparent(None) is None
+
+
+def test_sampled_trace_is_exported_with_children():
+    tracer, exporter = make_tracer(sample_rate=1)
+
+    with tracer.span("request", kind="server") as root:
+        with tracer.span("child") as child:
+            assert tracer.exemplar(0.001) == {"trace_id": root.trace_id}
+
+    assert [span.name for span in exporter.spans] == ["child", "request"]
+    assert child.parent_id == root.span_id
+    assert child.trace_id == root.trace_id
+
+
+def test_unsampled_trace_is_exported_only_when_slow_or_failed():
+    tracer, exporter = make_tracer(sample_rate=0, slow_threshold=60)
+
+    with tracer.span("fast", kind="server"):
+        assert tracer.exemplar(0.001) is None
+    assert exporter.spans == []
+
+    with pytest.raises(ValueError):
+        with tracer.span("failed", kind="server"):
+            raise ValueError("boom")
+    assert exporter.spans[0].error
+
+    exporter.clear()
+    tracer.slow_threshold = 0
+    with tracer.span("slow", kind="server"):
+        pass
+    assert [span.name for span in exporter.spans] == ["slow"]
+
+
+def test_failed_child_exports_trace_of_recovered_request():
+    tracer, exporter = make_tracer(sample_rate=0, slow_threshold=60)
+
+    with tracer.span("request", kind="server") as root:
+        assert tracer.exemplar(0.001, error=True) == {"trace_id": root.trace_id}
+        with pytest.raises(ValueError):
+            with tracer.span("db INSERT", kind="client"):
+                raise ValueError("duplicate key")
+
+    assert not root.error
+    assert [span.name for span in exporter.spans] == ["db INSERT", "request"]
+
+
+def test_remote_parent_is_continued():
+    tracer, exporter = make_tracer(sample_rate=0)
+
+    with tracer.span("request", kind="server", traceparent=TRACEPARENT) as span:
+        pass
+
+    assert span.trace_id == "4bf92f3577b34da6a3ce929d0e0e4736"
+    assert span.parent_id == "00f067aa0ba902b7"
+    assert exporter.spans == [span]
+
+
+def test_middleware_propagates_trace_context():
+    tracer, exporter = make_tracer(sample_rate=0)
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def read_item(item_id: int):
+        return {"id": item_id}
+
+    app.add_middleware(TracingMiddleware, tracer=tracer)
+    response = TestClient(app).get("/items/1", headers={"traceparent": TRACEPARENT})
+
+    trace_id, parent_id, sampled = parse_traceparent(response.headers["traceparent"])
+    assert trace_id == "4bf92f3577b34da6a3ce929d0e0e4736"
+    assert sampled
+    assert exporter.spans[0].name == "GET /items/{item_id}"
+    assert exporter.spans[0].attributes["http.status_code"] == 200
+
+
+@pytest.mark.asyncio
+async def test_sql_statements_get_child_spans(monkeypatch):
+    tracer, exporter = make_tracer(sample_rate=1)
+    monkeypatch.setattr("src.database.tracer", tracer)
+    engine = instrument_engine(create_async_engine("sqlite+aiosqlite://"))
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with session_factory() as db:
+        db.add(Message(text="traced"))
+        await db.commit()
+        exporter.clear()
+        with tracer.span("request", kind="server") as root:
+            await get_message(db, 1)
+
+    await engine.dispose()
+    query_span = exporter.spans[0]
+    assert query_span.name == "db SELECT"
+    assert query_span.parent_id == root.span_id
+    assert query_span.attributes["db.system"] == "sqlite"
+
+
+@pytest.mark.asyncio
+async def test_pool_checkout_gets_a_span_on_first_use(monkeypatch, tmp_path):
+    tracer, exporter = make_tracer(sample_rate=1)
+    monkeypatch.setattr("src.database.tracer", tracer)
+    engine = instrument_engine(create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/pool.db",
+                                                   poolclass=TracedAsyncAdaptedQueuePool))
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with session_factory() as db:
+        db.add(Message(text="traced"))
+        await db.commit()
+    exporter.clear()
+
+    with tracer.span("request", kind="server") as root:
+        async with session_factory() as db:
+            assert [span.name for span in root.trace.spans] == []
+            await get_message(db, 1)
+            await get_message(db, 1)
+
+    await engine.dispose()
+    assert [span.name for span in exporter.spans] == ["db.pool.checkout", "db SELECT", "db SELECT", "request"]
+    assert exporter.spans[0].parent_id == root.span_id